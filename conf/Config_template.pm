@@ -69,4 +69,10 @@ $r_scripts = "$ROOT/src/MGRAST/r/";
 $fraggenescan_executable = "/soft/packages/FragGeneScan/1.15/bin/FragGeneScan";
 $run_fraggenescan = "/soft/packages/FragGeneScan/1.15/bin/run_FragGeneScan.pl";
 
+# Cassandra matrix / profile builds
+# worker processes a matrix or profile build scans job rows in, 1 builds in the API process
+$cassandra_workers = 1;
+# job records held at once to annotate distinct md5s across matrix columns, unset for default (1000000), 0 to turn off
+$matrix_dedup_records = undef;
+
 1;
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+__doc__ = """
+Script to compare cutoff filtered scans of a job in JobHandle against a cassandra cluster.
+Times the ALLOW FILTERING scan of job_md5s / job_lcas against the read of the
+qualifying cutoff buckets, the job must have been loaded with cutoff buckets.
+
+Output (tab seperated) per mode:
+   mode, rows, seconds, rows / second"""
+
+def main(args):
+    parser = OptionParser(usage="usage: %prog [options]\n"+__doc__)
+    parser.add_option("--hosts", dest="hosts", default="localhost", help="comma seperated list of cassandra hosts, default localhost")
+    parser.add_option("--version", dest="version", type="int", default=1, help="M5NR version, default 1")
+    parser.add_option("--job", dest="job", type="int", default=None, help="job id to scan")
+    parser.add_option("--type", dest="type", default="md5", help="md5 or lca rows, default md5")
+    parser.add_option("--evalue", dest="evalue", type="int", default=5, help="evalue exponent cutoff, default 5")
+    parser.add_option("--identity", dest="identity", type="int", default=60, help="percent identity cutoff, default 60")
+    parser.add_option("--length", dest="length", type="int", default=15, help="alignment length cutoff, default 15")
+    parser.add_option("--pylib", dest="pylib", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pylib'), help="path to MG-RAST pylib directory")
+    (opts, args) = parser.parse_args()
+    if not opts.job:
+        parser.error("missing required job id")
+    if opts.type not in ['md5', 'lca']:
+        parser.error("type must be md5 or lca")
+
+    sys.path.insert(1, opts.pylib)
+    import mgrast_cassandra
+
+    handle = mgrast_cassandra.JobHandle(opts.hosts.split(","), opts.version)
+    if not handle.has_cutoffs(opts.job, opts.type):
+        sys.stderr.write("job %d has no %s cutoff buckets, reload it first\n"%(opts.job, opts.type))
+        return 1
+    scan = handle.get_job_records if opts.type == 'md5' else handle.get_lca_records
+    for mode, buckets in [('filtering', False), ('buckets', True)]:
+        handle.cutoff_buckets = buckets
+        start = time.time()
+        rows = 0
+        for r in scan(opts.job, [opts.type, 'abundance'], None, opts.evalue, opts.identity, opts.length):
+            rows += 1
+        secs = time.time() - start
+        rate = (rows / secs) if secs > 0 else 0
+        sys.stdout.write("%s\t%d\t%.3f\t%.1f\n"%(mode, rows, secs, rate))
+    handle.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
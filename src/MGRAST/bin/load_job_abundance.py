@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+__doc__ = """
+Script to bulk load the md5 and / or lca abundance files of a job into the
+cassandra job_md5s / job_lcas tables and their cutoff bucket tables, bypassing the API.
+Rows are written as concurrent unlogged batches, progress is saved to a
+checkpoint file after each chunk so a failed load can be rerun to resume.
+The helper tables of Schema/mgrast_abundance_helpers.cql must exist.
+
+Input files are tab seperated:
+   md5: md5, abundance, exp_avg, ident_avg, len_avg, seek, length
+   lca: lca, abundance, exp_avg, ident_avg, len_avg, md5s, level"""
+
+COLUMNS = 7
+
+def main(args):
+    parser = OptionParser(usage="usage: %prog [options]\n"+__doc__)
+    parser.add_option("--hosts", dest="hosts", default="localhost", help="comma seperated list of cassandra hosts, default localhost")
+    parser.add_option("--version", dest="version", type="int", default=1, help="M5NR version, default 1")
+    parser.add_option("--job", dest="job", type="int", default=None, help="job id to load")
+    parser.add_option("--md5", dest="md5", default=None, help="md5 abundance file")
+    parser.add_option("--lca", dest="lca", default=None, help="lca abundance file")
+    parser.add_option("--writers", dest="writers", type="int", default=16, help="concurrent batches in flight, default 16")
+    parser.add_option("--batch", dest="batch", type="int", default=100, help="rows per batch, default 100")
+    parser.add_option("--chunk", dest="chunk", type="int", default=50000, help="rows per checkpoint, default 50000")
+    parser.add_option("--checkpoint", dest="checkpoint", default=None, help="checkpoint file, default <job>.abundance.checkpoint")
+    parser.add_option("--pylib", dest="pylib", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pylib'), help="path to MG-RAST pylib directory")
+    (opts, args) = parser.parse_args()
+    if not opts.job:
+        parser.error("missing required job id")
+    files = []
+    for val in ['md5', 'lca']:
+        path = getattr(opts, val)
+        if path:
+            if not os.path.isfile(path):
+                parser.error("%s file %s does not exist"%(val, path))
+            files.append((val, path))
+    if len(files) == 0:
+        parser.error("missing md5 and / or lca file")
+
+    sys.path.insert(1, opts.pylib)
+    import bulk_load
+    import mgrast_cassandra
+
+    ckpt = bulk_load.Checkpoint(opts.checkpoint or "%d.abundance.checkpoint"%opts.job)
+    stats = bulk_load.Throughput()
+    handle = mgrast_cassandra.JobHandle(opts.hosts.split(","), opts.version)
+    writer = bulk_load.BatchWriter(handle.session, writers=opts.writers, size=opts.batch)
+    if not handle.has_job(opts.job):
+        handle.insert_job_info(opts.job)
+
+    for val, path in files:
+        state = ckpt.get(val)
+        if state['done']:
+            sys.stderr.write("%s already loaded: %d rows\n"%(val, state['rows']))
+            continue
+        if state['offset'] == 0:
+            # fresh start, clear count of previous load
+            if val == 'md5':
+                handle.update_info_md5s(opts.job, 0, False)
+            else:
+                handle.update_info_lcas(opts.job, 0, False)
+        else:
+            sys.stderr.write("resuming %s at row %d\n"%(val, state['rows']))
+        total = state['rows']
+        offset = state['offset']
+        skipped = 0
+        for rows, offset in bulk_load.read_rows(path, state['offset'], opts.chunk):
+            good = [r for r in rows if len(r) == COLUMNS]
+            skipped += len(rows) - len(good)
+            start = time.time()
+            handle.write_job_rows(writer, val, handle.job_params(opts.job, val, good))
+            stats.add(val, len(good), time.time() - start)
+            total += len(good)
+            ckpt.save(val, offset, total)
+            sys.stderr.write("%s: %d rows loaded, %.1f rows/sec\n"%(val, total, stats.rate(val)))
+        # one count update, replaces counter
+        if val == 'md5':
+            handle.update_info_md5s(opts.job, total, False)
+        else:
+            handle.update_info_lcas(opts.job, total, False)
+        ckpt.save(val, offset, total, done=True)
+        if skipped:
+            sys.stderr.write("%s: skipped %d malformed lines\n"%(val, skipped))
+
+    handle.set_loaded(opts.job, True)
+    ckpt.remove()
+    stats.report()
+    if writer.timeouts:
+        sys.stderr.write("%d write timeouts retried\n"%writer.timeouts)
+    handle.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
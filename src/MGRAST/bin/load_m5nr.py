@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+__doc__ = """
+Script to load Babel source files into the md5_annotation table of a M5NR
+cassandra keyspace (m5nr_vN), creating the keyspace if missing.
+Rows are written as concurrent unlogged batches, progress is saved to a
+checkpoint file per input file so a failed load can be rerun to resume.
+
+Input files are tab seperated and must be sorted by md5 (sort -t $'\\t' -k1,1):
+   .md52id2func: md5, id, function, organism, source, ...  (--func protein, --rna rRNA sources)
+   .md52id2ont:  md5, id, function, ontology, source       (--ont)
+Only columns present in the input are written: is_protein (from --func / --rna),
+accession, function and organism. single and lca are not in Babel files and
+are left as they are, they come from the M5NR build through m5nr/cassandra/insert.
+
+Output (tab seperated) per table:
+   table, rows, seconds, rows / second"""
+
+TABLE = "md5_annotation"
+
+def main(args):
+    parser = OptionParser(usage="usage: %prog [options]\n"+__doc__)
+    parser.add_option("--hosts", dest="hosts", default="localhost", help="comma seperated list of cassandra hosts, default localhost")
+    parser.add_option("--version", dest="version", type="int", default=None, help="M5NR version to load")
+    parser.add_option("--func", dest="func", action="append", default=[], help="md52id2func file of a protein source, may be used multiple times")
+    parser.add_option("--rna", dest="rna", action="append", default=[], help="md52id2func file of a rRNA source, may be used multiple times")
+    parser.add_option("--ont", dest="ont", action="append", default=[], help="md52id2ont file, may be used multiple times")
+    parser.add_option("--writers", dest="writers", type="int", default=16, help="concurrent batches in flight, default 16")
+    parser.add_option("--batch", dest="batch", type="int", default=100, help="rows per batch, default 100")
+    parser.add_option("--chunk", dest="chunk", type="int", default=50000, help="rows per checkpoint, default 50000")
+    parser.add_option("--checkpoint", dest="checkpoint", default=None, help="checkpoint file, default m5nr_v<version>.checkpoint")
+    parser.add_option("--pylib", dest="pylib", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pylib'), help="path to MG-RAST pylib directory")
+    (opts, args) = parser.parse_args()
+    if not opts.version:
+        parser.error("missing required M5NR version")
+    files = [(f, 'protein') for f in opts.func] + [(f, 'rna') for f in opts.rna] + [(f, 'ontology') for f in opts.ont]
+    if len(files) == 0:
+        parser.error("missing md52id2func and / or md52id2ont files")
+    for f, _ in files:
+        if not os.path.isfile(f):
+            parser.error("file %s does not exist"%f)
+
+    sys.path.insert(1, opts.pylib)
+    import m5nr
+    import bulk_load
+
+    ckpt = bulk_load.Checkpoint(opts.checkpoint or "m5nr_v%d.checkpoint"%opts.version)
+    stats = bulk_load.Throughput()
+    upload = m5nr.M5nrUpload(opts.hosts.split(","), opts.version)
+    # an existing keyspace is kept when resuming, only missing tables are created
+    if upload.hasKeyspace():
+        error = upload.createTables()
+    else:
+        error = upload.createNewM5nr()
+    if error:
+        sys.stderr.write(error+"\n")
+        return 1
+    writer = bulk_load.BatchWriter(upload.session, writers=opts.writers, size=opts.batch)
+    partition = lambda p: p[0]
+
+    for path, kind in files:
+        name = os.path.abspath(path)
+        insert = upload.annotationStatement(kind)
+        state = ckpt.get(name)
+        if state['done']:
+            sys.stderr.write("%s already loaded: %d rows\n"%(path, state['rows']))
+            continue
+        if state['offset'] > 0:
+            sys.stderr.write("resuming %s at row %d\n"%(path, state['rows']))
+        total = state['rows']
+        offset = state['offset']
+        rows = []
+        for md5, source, lines, end in m5nr.read_babel(path, state['offset']):
+            rows.append(m5nr.annotation_row(md5, source, lines, kind))
+            offset = end
+            if len(rows) >= opts.chunk:
+                total += load(writer, insert, rows, partition, stats)
+                ckpt.save(name, offset, total)
+                sys.stderr.write("%s: %d rows loaded, %.1f rows/sec\n"%(path, total, stats.rate(TABLE)))
+                rows = []
+        if rows:
+            total += load(writer, insert, rows, partition, stats)
+        ckpt.save(name, offset, total, done=True)
+        sys.stderr.write("%s: done, %d rows loaded\n"%(path, total))
+
+    ckpt.remove()
+    stats.report()
+    if writer.timeouts:
+        sys.stderr.write("%d write timeouts retried\n"%writer.timeouts)
+    upload.close()
+    return 0
+
+def load(writer, insert, rows, partition, stats):
+    start = time.time()
+    writer.write(insert, rows, partition)
+    stats.add(TABLE, len(rows), time.time() - start)
+    return len(rows)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
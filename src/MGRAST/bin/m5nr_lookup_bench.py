@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+__doc__ = """
+Script to compare M5NR annotation lookup modes of M5nrHandle against a cassandra cluster.
+Reads md5s (first tab seperated column) from a file and times the
+multi-partition IN query path against concurrent single partition selects.
+
+Output (tab seperated) per mode:
+   mode, md5s, records, seconds, md5s / second"""
+
+def main(args):
+    parser = OptionParser(usage="usage: %prog [options]\n"+__doc__)
+    parser.add_option("--hosts", dest="hosts", default="localhost", help="comma seperated list of cassandra hosts, default localhost")
+    parser.add_option("--version", dest="version", type="int", default=1, help="M5NR version, default 1")
+    parser.add_option("--md5s", dest="md5s", default=None, help="file with md5s to look up")
+    parser.add_option("--source", dest="source", default=None, help="annotation source, default all")
+    parser.add_option("--chunk", dest="chunk", type="int", default=100, help="md5s per lookup, default 100")
+    parser.add_option("--pylib", dest="pylib", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pylib'), help="path to MG-RAST pylib directory")
+    (opts, args) = parser.parse_args()
+    if not (opts.md5s and os.path.isfile(opts.md5s)):
+        parser.error("missing required md5 file")
+
+    sys.path.insert(1, opts.pylib)
+    import mgrast_cassandra
+
+    md5s = []
+    with open(opts.md5s) as fh:
+        for line in fh:
+            if line.strip():
+                md5s.append(line.strip().split('\t')[0])
+
+    handle = mgrast_cassandra.M5nrHandle(opts.hosts.split(","), opts.version, cache=False)
+    for mode in mgrast_cassandra.LOOKUP_MODES:
+        handle.set_lookup(mode)
+        found = 0
+        start = time.time()
+        for i in range(0, len(md5s), opts.chunk):
+            found += len(handle.get_records_by_md5(md5s[i:i+opts.chunk], source=opts.source, iterator=True))
+        secs = time.time() - start
+        rate = (len(md5s) / secs) if secs > 0 else 0
+        sys.stdout.write("%s\t%d\t%d\t%.3f\t%.1f\n"%(mode, len(md5s), found, secs, rate))
+    handle.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
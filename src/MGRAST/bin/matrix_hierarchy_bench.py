@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import copy
+import time
+import random
+from optparse import OptionParser
+
+__doc__ = """
+Script to time the row metadata join of Matrix.get_data on a synthetic taxonomy.
+Builds a NCBI like hierarchy of strain level entries and a matrix row per
+sampled strain, then times the indexed join against the former scan of the
+whole hierarchy per row (only run up to --scan-rows rows, it is quadratic).
+
+Output (tab seperated) per mode:
+   mode, rows, hierarchy entries, seconds, rows / second"""
+
+TAXONOMY = ['domain', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+
+def main(args):
+    parser = OptionParser(usage="usage: %prog [options]\n"+__doc__)
+    parser.add_option("--hierarchy", dest="hierarchy", type="int", default=500000, help="hierarchy entries, default 500000")
+    parser.add_option("--rows", dest="rows", type="int", default=50000, help="matrix rows, default 50000")
+    parser.add_option("--scan-rows", dest="scan_rows", type="int", default=2000, help="rows for the per row scan, 0 to skip, default 2000")
+    parser.add_option("--seed", dest="seed", type="int", default=1, help="random seed, default 1")
+    parser.add_option("--pylib", dest="pylib", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pylib'), help="path to MG-RAST pylib directory")
+    (opts, args) = parser.parse_args()
+    if opts.rows > opts.hierarchy:
+        parser.error("rows can not exceed hierarchy entries")
+
+    sys.path.insert(1, opts.pylib)
+    import matrix
+
+    random.seed(opts.seed)
+    hierarchy = []
+    for i in range(opts.hierarchy):
+        h = dict((t, "%s_%d"%(t, i % (10 ** (n + 1)))) for n, t in enumerate(TAXONOMY))
+        h['organism'] = "strain_%d"%i
+        h['ncbi_tax_id'] = i
+        hierarchy.append(h)
+    ids = [h['organism'] for h in random.sample(hierarchy, opts.rows)]
+
+    modes = [('index', ids, join_index)]
+    if opts.scan_rows > 0:
+        modes.append(('scan', ids[:opts.scan_rows], join_scan))
+    for mode, mids, join in modes:
+        rows = [{'id': r, 'metadata': None} for r in mids]
+        hier = copy.deepcopy(hierarchy) if mode == 'scan' else hierarchy
+        start = time.time()
+        join(matrix, rows, hier, 'organism')
+        secs = time.time() - start
+        rate = (len(rows) / secs) if secs > 0 else 0
+        sys.stdout.write("%s\t%d\t%d\t%.3f\t%.1f\n"%(mode, len(rows), len(hier), secs, rate))
+    return 0
+
+def join_index(matrix, rows, hierarchy, hier_match):
+    matrix.join_hierarchy(rows, hierarchy, hier_match)
+
+# previous join, scans hierarchy for every row and changes matched entries
+def join_scan(matrix, rows, hierarchy, hier_match):
+    for r in rows:
+        for h in hierarchy:
+            if hier_match not in h:
+                continue
+            if r['id'] == h[hier_match]:
+                h['strain'] = h.pop('organism')
+                tid = h.pop('ncbi_tax_id')
+                r['metadata'] = { 'hierarchy': h, 'ncbi_tax_id': tid }
+                break
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -316,7 +316,7 @@ sub prepare_data {
     }
     
     # get indexes
-    # get_md5_records(self, job, md5s=None, evalue=None, identity=None, alength=None):
+    # get_md5_records(self, job, swap=None, md5s=None, evalue=None, identity=None, alength=None, form="list"):
     $eval  = (defined($eval)  && ($eval  =~ /^\d+$/)) ? int($eval)  : undef;
     $ident = (defined($ident) && ($ident =~ /^\d+$/)) ? int($ident) : undef;
     $alen  = (defined($alen)  && ($alen  =~ /^\d+$/)) ? int($alen)  : undef;
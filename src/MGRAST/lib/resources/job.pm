@@ -1024,8 +1024,8 @@ sub job_action {
                 unless ($rows && (scalar(@$rows) > 0)) {
                     $self->return_data( {"ERROR" => "missing required 'data' for loading"}, 400 );
                 }
-                # insert batch is atomic and sets loaded=false, update_on=time.now() in job_info
-                # data->loaded is current total loaded
+                # rows are counted server side, sets loaded=false, update_on=time.now() in job_info
+                # data->loaded is current total loaded, loads of one job may run in parallel
                 if ($type eq "md5") {
                     $data->{loaded} = $mgcass->insert_job_md5s($jobid, $rows);
                 } elsif ($type eq "lca") {
@@ -402,6 +402,25 @@ sub info {
                                    'required' => {},
                                    'options'  => {}
                                }
+                           },
+                           {
+                               'name'        => 'finish',
+                               'request'     => $self->url."/".$self->name."/cassandra/finish",
+                               'description' => "End taxonomy / ontology inserts for M5NR version, cached hierarchies are rebuilt, requires admin auth token",
+                               'method'      => "POST",
+                               'type'        => "synchronous",
+                               'attributes'  => {
+                                   'status' => ['string', 'status of action'],
+                                   'error'  => ['string', 'error message if any'],
+                                   'time'   => ['date', 'time action was completed']
+                               },
+                               'parameters' => {
+                                   'body' => {
+                                       'version' => ['integer', 'M5NR version']
+                                   },
+                                   'required' => {},
+                                   'options'  => {}
+                               }
                            }
    				       ]
 		};
@@ -772,6 +791,8 @@ sub cassandra {
             $m5nrcass->close();
             return $self->return_data({"ERROR", "missing required table and/or data"}, 404);
         }
+    } elsif ($action eq 'finish') {
+        $error = $m5nrcass->finishHierarchy();
     } else {
         $m5nrcass->close();
         return $self->return_data({"ERROR", "invalid request"}, 404);
@@ -104,6 +104,8 @@ sub info {
                       'filter_level' => [ 'cv', $self->hierarchy->{ontology} ],
                       'filter_source' => [ 'cv', $self->{sources}{ontology} ],
                       'hide_metadata' => [ 'boolean', "if true do not return metagenome metadata in 'columns' object, default is false" ],
+                      'matrix_type' => [ 'cv', [['dense', 'return data as list of rows, default if more than a third of cells are non-zero'],
+                                                ['sparse', 'return data as list of [row, column, value] of non-zero cells, default otherwise']] ],
                       'version' => [ 'int', 'M5NR version, default '.$self->{m5nr_default} ] },
 				  'required' => {},
                   'body'     => {} }
@@ -133,6 +135,8 @@ sub info {
 					       'filter_level' => [ 'cv', $self->hierarchy->{organism} ],
 					       'filter_source' => [ 'cv', $self->{sources}{organism} ],
 					       'hide_metadata' => [ 'boolean', "if true do not return metagenome metadata in 'columns' object, default is false" ],
+					       'matrix_type' => [ 'cv', [['dense', 'return data as list of rows, default if more than a third of cells are non-zero'],
+									 ['sparse', 'return data as list of [row, column, value] of non-zero cells, default otherwise']] ],
 					       'version' => [ 'int', 'M5NR version, default '.$self->{m5nr_default} ] },
 				  'required' => {},
                   'body'     => {} }
@@ -286,6 +290,7 @@ sub process_parameters {
     my $filter = $cgi->param('filter') ? $cgi->param('filter') : "";
     my $hide_md = $cgi->param('hide_metadata') ? 1 : 0;
     my $hide_hy = $cgi->param('hide_hierarchy') ? 1 : 0;
+    my $mtype   = $cgi->param('matrix_type') || undef;
     my $version = $cgi->param('version') || $self->{m5nr_default};
     my $leaf_node = 0;
     my $prot_func = 0;
@@ -376,6 +381,10 @@ sub process_parameters {
         $matrix_id .= '_'.$grep;
         $matrix_url .= '&grep='.$grep;
     }
+    if ($mtype) {
+        $matrix_id .= '_'.$mtype;
+        $matrix_url .= '&matrix_type='.$mtype;
+    }
     
     # validate cutoffs
     $eval  = (defined($eval)  && ($eval  =~ /^\d+$/)) ? int($eval)  : undef;
@@ -395,6 +404,9 @@ sub process_parameters {
     unless (exists $result_map->{$rtype}) {
         return ({"ERROR" => "invalid result_type for matrix call: ".$rtype." - valid types are [".join(", ", keys %$result_map)."]"}, undef, undef);
     }
+    if ($mtype && ($mtype !~ /^(dense|sparse)$/)) {
+        return ({"ERROR" => "invalid matrix_type for matrix call: ".$mtype." - valid types are [dense, sparse]"}, undef, undef);
+    }
     if ($type eq 'organism') {
         if ( any {$_ eq $glvl} @tax_hier ) {
             if ($glvl eq 'strain') {
@@ -535,7 +547,9 @@ sub process_parameters {
         filter_level  => $flvl,
         filter_source => $fsrc,
         leaf_node     => $leaf_node,
-        leaf_filter   => $leaf_filter
+        leaf_filter   => $leaf_filter,
+        matrix_type   => $mtype,
+        dedup         => $Conf::matrix_dedup_records
     };
     return ($params, $metadata, $hierarchy);
 }
@@ -549,6 +563,10 @@ sub create_matrix {
     # set shock
     my $token = $self->mgrast_token;
     $mgcass->set_shock($token);
+    # split job scans across worker processes, if configured
+    if ($Conf::cassandra_workers && ($Conf::cassandra_workers > 1)) {
+        $mgcass->set_processes($Conf::cassandra_workers);
+    }
     
     ### create matrix / saves output file or error message in shock
     $mgcass->compute_matrix($node, $params, $metadata, $hierarchy);
@@ -100,6 +100,8 @@ sub info {
                                              ['lca', 'compressed json format with LCA annotations'],
                                              ['biom','BIOM json format']]],
                       'source'    => ['cv', $self->{sources}],
+                      'matrix_type' => ['cv', [['dense','biom format data as list of rows, default if more than a third of cells are non-zero'],
+                                               ['sparse','biom format data as list of [row, column, value] of non-zero cells, default otherwise']]],
                       'version'   => ['integer', 'M5NR version, default is '.$self->{m5nr_default}],
                       'verbosity' => ['cv', [['full','returns all data (default)'],
                                              ['minimal','returns only minimal information']]]
@@ -205,9 +207,13 @@ sub submit {
     my $format    = $self->cgi->param('format') || 'mgrast';
     my $retry     = $self->cgi->param('retry') ? int($self->cgi->param('retry')) : 0;
     my $debug     = $self->cgi->param('debug') ? 1 : 0;
+    my $mtype     = $self->cgi->param('matrix_type') || undef;
     unless (($retry =~ /^\d+$/) && ($retry > 0)) {
         $retry = 0;
     }
+    if ($mtype && ($mtype !~ /^(dense|sparse)$/)) {
+        $self->return_data( {"ERROR" => "invalid matrix_type for profile: ".$mtype." - valid types are [dense, sparse]"}, 400 );
+    }
     
     if ($format eq 'lca') {
         $source    = 'LCA';
@@ -282,6 +288,7 @@ sub submit {
         format      => $format,
         retry       => $retry,
         condensed   => $condensed,
+        matrix_type => $mtype,
         version     => $version
     };
     my $expire = ($format =~ /^(mgrast|lca)$/) ? "1D" : "7D";
@@ -359,6 +366,10 @@ sub create_profile {
     # set shock
     my $token = $self->mgrast_token;
     $mgcass->set_shock($token);
+    # split job scans across worker processes, if configured
+    if ($Conf::cassandra_workers && ($Conf::cassandra_workers > 1)) {
+        $mgcass->set_processes($Conf::cassandra_workers);
+    }
     
     ### saves output file or error message in shock
     $mgcass->compute_profile($node, $param, $attr);
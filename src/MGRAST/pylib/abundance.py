@@ -1,30 +1,180 @@
 
 import re
-import time
-import json
+import array
+import numpy as np
 import shock
+import progress
+import hierarchy
 import mgrast_cassandra
-from collections import defaultdict
 
-UPDATE_SECS  = 300
-M5NR_VERSION = 1
-CHUNK_SIZE   = 100
+UPDATE_SECS   = 300
+M5NR_VERSION  = 1
+CHUNK_SIZE    = 100
+LOOKUP_WINDOW = 8
+FLUSH_SIZE    = 65536
 SKIP_RE = re.compile('other|unknown|unclassified')
 
+class CodedCounter(object):
+    """Sums of values per integer id. Pairs are buffered and added to an
+    int64 array per flush, ids added at least once are marked as touched."""
+    def __init__(self, size=0):
+        self.sums = np.zeros(size, dtype=np.int64)
+        self.touched = np.zeros(size, dtype=bool)
+        self.ids = array.array('l')
+        self.vals = array.array('l')
+    def add(self, i, value):
+        self.ids.append(i)
+        self.vals.append(value)
+        if len(self.ids) >= FLUSH_SIZE:
+            self.flush()
+    def flush(self):
+        if len(self.ids) == 0:
+            return
+        ids  = np.frombuffer(self.ids, dtype=np.dtype('l')).astype(np.int64)
+        vals = np.frombuffer(self.vals, dtype=np.dtype('l')).astype(np.int64)
+        top  = int(ids.max()) + 1
+        if top > len(self.sums):
+            grow = max(top, 2 * len(self.sums)) - len(self.sums)
+            self.sums = np.concatenate((self.sums, np.zeros(grow, dtype=np.int64)))
+            self.touched = np.concatenate((self.touched, np.zeros(grow, dtype=bool)))
+        np.add.at(self.sums, ids, vals)
+        self.touched[ids] = True
+        self.ids = array.array('l')
+        self.vals = array.array('l')
+    # ( touched ids, their sums )
+    def totals(self):
+        self.flush()
+        ids = np.nonzero(self.touched)[0]
+        return ids, self.sums[ids]
+
+# sums of values by level code, as name : sum
+def level_sums(names, codes, sums):
+    found = {}
+    if len(codes) == 0:
+        return found
+    uniq, inverse = np.unique(codes, return_inverse=True)
+    level = np.zeros(len(uniq), dtype=np.int64)
+    np.add.at(level, inverse, sums)
+    for c, v in zip(uniq.tolist(), level.tolist()):
+        found[names[c] if c >= 0 else None] = v
+    return found
+
+class CodedAbundance(object):
+    """Abundance of annotations of one job, summed over integer ids.
+    Organism and ontology names are interned by the hierarchy snapshot, functions
+    by a local table. Taxa levels, skipped organisms and ontology levels are applied
+    once to the summed ids, only the final maps are translated back to names."""
+    def __init__(self, hier, taxa=[], org=0, fun=0, ont=0):
+        self.taxa = list(taxa) if org else []
+        self.org = None
+        self.fun = None
+        self.ont = None
+        if self.taxa:
+            self.org_names, self.org_ids = hier.namespace('taxonomy')
+            if len(self.taxa) == 1:
+                # organism : taxa of level
+                self.org_levels = [ hier.array("tax_"+self.taxa[0].lower()) ]
+            else:
+                # organism : [ taxa ], by position in taxa list
+                taxa_arr = hier.array('taxa')
+                self.org_levels = [ taxa_arr[:,i] for i in range(len(self.taxa)) ]
+            self.org = CodedCounter(len(self.org_names))
+        if fun:
+            self.fun_ids = {}
+            self.fun_names = []
+            self.fun = CodedCounter()
+        if ont:
+            self.ont_names, self.ont_ids = hier.namespace('ontology')
+            # source : ontology : level1, sources with a mapping only
+            self.ont_levels = {}
+            for source, smap in hier.ontology_map('level1').items():
+                self.ont_levels[source] = smap.array
+            self.ont = {}
+    
+    def add(self, rec, abundance):
+        if (self.fun is not None) and rec['function']:
+            for f in rec['function']:
+                i = self.fun_ids.get(f)
+                if i is None:
+                    i = len(self.fun_names)
+                    self.fun_ids[f] = i
+                    self.fun_names.append(f)
+                self.fun.add(i, abundance)
+        if (self.ont is not None) and (rec['source'] in self.ont_levels) and rec['accession']:
+            if rec['source'] not in self.ont:
+                self.ont[rec['source']] = CodedCounter(len(self.ont_names))
+            counter = self.ont[rec['source']]
+            for a in rec['accession']:
+                i = self.ont_ids.get(a)
+                if i is not None:
+                    counter.add(i, abundance)
+        if (self.org is not None) and rec['organism']:
+            for o in rec['organism']:
+                i = self.org_ids.get(o)
+                if i is not None:
+                    self.org.add(i, abundance)
+    
+    # org_map: tax_lvl : taxa : abundance, fun_map: func : abundance, ont_map: source : level1 : abundance
+    def results(self):
+        org_map = {}
+        fun_map = {}
+        ont_map = {}
+        if self.org is not None:
+            ids, sums = self.org.totals()
+            ids, sums = self.known(ids, sums, self.org_levels[0])
+            skip = np.array([SKIP_RE.match(self.org_names[i]) is not None for i in ids.tolist()], dtype=bool)
+            for t, levels in zip(self.taxa, self.org_levels):
+                keep = ~skip if t == 'domain' else np.ones(len(ids), dtype=bool)
+                org_map[t] = level_sums(self.org_names, levels[ids[keep]], sums[keep])
+        if self.fun is not None:
+            ids, sums = self.fun.totals()
+            fun_map = dict(zip([self.fun_names[i] for i in ids.tolist()], sums.tolist()))
+        if self.ont is not None:
+            for source, counter in self.ont.items():
+                levels = self.ont_levels[source]
+                ids, sums = self.known(*counter.totals(), levels=levels)
+                ont_map[source] = level_sums(self.ont_names, levels[ids], sums)
+        return org_map, fun_map, ont_map
+    
+    # ids that are keys of the level array
+    def known(self, ids, sums, levels):
+        inside = ids < len(levels)
+        ids, sums = ids[inside], sums[inside]
+        keep = np.asarray(levels[ids]) != hierarchy.ABSENT
+        return ids[keep], sums[keep]
+
 class Abundance(object):
-    def __init__(self, hosts, version=M5NR_VERSION, chunk=CHUNK_SIZE):
+    def __init__(self, hosts, version=M5NR_VERSION, chunk=CHUNK_SIZE, window=LOOKUP_WINDOW):
         self.m5nr = mgrast_cassandra.M5nrHandle(hosts, version)
         self.jobs = mgrast_cassandra.JobHandle(hosts, version)
         self.chunk = int(chunk)
         self.shock = None
+        self.reporter = None
+        self.set_window(window)
+    
+    # number of annotation lookups kept in flight while scanning job rows
+    def set_window(self, window=LOOKUP_WINDOW):
+        self.window = int(window)
     
     def set_shock(self, token=None, bearer='mgrast', url='http://shock.mg-rast.org'):
         self.shock = shock.ShockClient(shock_url=url, bearer=bearer, token=token)
     
     def close(self):
+        if self.reporter:
+            self.reporter.stop()
+        self.log_shock()
         self.m5nr.close()
         self.jobs.close()
     
+    # shock request counters of the build, logged when it finishes
+    def log_shock(self):
+        if self.shock is None:
+            return
+        stats = self.shock.get_stats()
+        if stats['requests'] > 0:
+            mgrast_cassandra.rmqLogger(self.jobs.channel, 'shock', self.shock.shock_url, stats=stats)
+        self.shock.reset_stats()
+    
     def all_md5s(self, job):
         job = int(job)
         md5s = []
@@ -35,60 +185,18 @@ class Abundance(object):
     
     def all_annotation_abundances(self, job, taxa=[], org=0, fun=0, ont=0, node=None):
         job = int(job)
-        class local:
-            tax = ""
-            found   = 0
-            tax_map = {}
-            org_map = {}                 # tax_lvl : taxa : abundance
-            fun_map = defaultdict(int)   # func : abundance
-            ont_map = {}                 # source : level1 : abundance
-            ont_cat = {}                 # source : ontID : level1
-        
-        if org and (len(taxa) == 1):
-            local.tax = taxa[0]
-            # org : taxa
-            local.tax_map = self.m5nr.get_org_taxa_map(local.tax)
-            local.org_map[taxa[0]] = defaultdict(int)
-        elif org and (len(taxa) > 1):
-            # org : [ taxa ]
-            local.tax_map = self.m5nr.get_taxa_hierarchy()
-            for t in taxa:
-                local.org_map[t] = defaultdict(int)
-        if ont:
-            local.ont_cat = self.m5nr.get_ontology_map("level1")
+        found = 0
+        counts = CodedAbundance(self.m5nr.get_hierarchy() if (org or ont) else None, taxa, org, fun, ont)
+        lookups = mgrast_cassandra.LookupPipeline(self.m5nr, window=self.window)
         
-        def add_annotations(md5s):
-            records = self.m5nr.get_records_by_md5(md5s.keys(), iterator=True)
+        def add_annotations(md5s, records):
             for rec in records:
-                local.found += 1
-                if fun and rec['function']:
-                    for f in rec['function']:
-                        local.fun_map[f] += md5s[rec['md5']]
-                if ont and (rec['source'] in local.ont_cat) and rec['accession']:
-                    if rec['source'] not in local.ont_map:
-                        local.ont_map[rec['source']] = defaultdict(int)
-                    for a in rec['accession']:
-                        if a in local.ont_cat[rec['source']]:
-                            level = local.ont_cat[rec['source']][a]
-                            local.ont_map[rec['source']][level] += md5s[rec['md5']]
-                if org and rec['organism']:
-                    for o in rec['organism']:
-                        if o not in local.tax_map:
-                            continue
-                        skip_m = SKIP_RE.match(o)
-                        if local.tax:
-                            if (local.tax == 'domain') and skip_m:
-                                continue
-                            local.org_map[local.tax][local.tax_map[o]] += md5s[rec['md5']]
-                        else:
-                            for i, _ in enumerate(taxa):
-                                if (taxa[i] == 'domain') and skip_m:
-                                    continue
-                                local.org_map[taxa[i]][local.tax_map[o][i]] += md5s[rec['md5']]
+                counts.add(rec, md5s[rec['md5']])
+            return len(records)
         
         total = 0
         count = 0
-        prev = time.time()
+        reporter = self.start_progress(node)
         md5s = {}
         rows = self.jobs.get_job_records(job, ['md5', 'abundance'])
         for r in rows:
@@ -96,28 +204,34 @@ class Abundance(object):
             count += 1
             total += 1
             if count == self.chunk:
-                add_annotations(md5s)
+                for chunk, records in lookups.submit(md5s.keys(), md5s):
+                    found += add_annotations(chunk, records)
                 md5s = {}
                 count = 0
             if (total % 1000) == 0:
-                prev = self.update_progress(node, total, local.found, prev)
+                reporter.report(self.progress_values(total, found, lookups))
         if count > 0:
-            add_annotations(md5s)
-        self.update_progress(node, total, local.found, 0) # last update
-        return [total, local.org_map, local.fun_map, local.ont_map]
+            for chunk, records in lookups.submit(md5s.keys(), md5s):
+                found += add_annotations(chunk, records)
+        for chunk, records in lookups.drain():
+            found += add_annotations(chunk, records)
+        org_map, fun_map, ont_map = counts.results()
+        reporter.close(self.progress_values(total, found, lookups, 'annotation')) # last update
+        self.log_shock()
+        return [total, org_map, fun_map, ont_map]
     
-    # only update if been more than UPDATE_SECS
-    def update_progress(self, node, total, found, prev):
-        now = time.time()
-        if self.shock and node and (now > (prev + UPDATE_SECS)):
-            attr = node['attributes']
-            attr['progress']['queried'] = total
-            attr['progress']['found'] = found
-            if prev == 0:
-                # final update
-                attr['progress']['completed'] = 'annotation'
-            self.shock.upload(node=node['id'], attr=json.dumps(attr))
-            return now
-        else:
-            return prev
+    # background updates of node progress, at most every UPDATE_SECS
+    def start_progress(self, node):
+        if self.reporter:
+            self.reporter.stop()
+        self.reporter = progress.ProgressReporter(self.shock, node, UPDATE_SECS)
+        return self.reporter
     
+    def progress_values(self, total, found, lookups=None, completed=None):
+        values = {'queried': total, 'found': found}
+        if lookups:
+            values['in_flight'] = lookups.in_flight()
+            values['queued'] = lookups.queued
+        if completed:
+            values['completed'] = completed
+        return values
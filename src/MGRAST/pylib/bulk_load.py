@@ -0,0 +1,133 @@
+
+import os
+import io
+import sys
+import json
+import time
+from collections import OrderedDict, deque
+import cassandra
+import cassandra.query as cql
+
+BATCH_SIZE = 100
+WRITERS    = 16
+CHUNK_ROWS = 50000
+RETRIES    = 8
+BACKOFF    = 0.5
+MAX_SLEEP  = 60
+RETRY_ERRORS = (cassandra.WriteTimeout, cassandra.OperationTimedOut, cassandra.Unavailable)
+
+class Throughput(object):
+    """Rows written and rows / second, per table."""
+    def __init__(self):
+        self.start = time.time()
+        self.tables = OrderedDict() # name : [ rows, seconds ]
+    def add(self, name, rows, secs):
+        if name not in self.tables:
+            self.tables[name] = [0, 0.0]
+        self.tables[name][0] += rows
+        self.tables[name][1] += secs
+    def rate(self, name):
+        rows, secs = self.tables.get(name, [0, 0.0])
+        return (rows / secs) if secs > 0 else 0.0
+    def report(self, stream=sys.stdout):
+        for name, (rows, secs) in self.tables.items():
+            stream.write("%s\t%d rows\t%.1f secs\t%.1f rows/sec\n"%(name, rows, secs, self.rate(name)))
+        stream.flush()
+
+class Checkpoint(object):
+    """JSON file of input name : { offset, rows, done }.
+    An offset is only saved once every row before it is written,
+    the file is replaced atomically so a crash leaves the last good state."""
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        if path and os.path.isfile(path):
+            with open(path) as fh:
+                self.state = json.load(fh)
+    def get(self, name):
+        return self.state.get(name, {'offset': 0, 'rows': 0, 'done': False})
+    def save(self, name, offset, rows, done=False):
+        self.state[name] = {'offset': offset, 'rows': rows, 'done': done}
+        if not self.path:
+            return
+        tmp = self.path+'.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.state, fh)
+        os.rename(tmp, self.path)
+    def remove(self):
+        if self.path and os.path.isfile(self.path):
+            os.remove(self.path)
+        self.state = {}
+
+class BatchWriter(object):
+    """Writes bound params as unlogged batches of one partition each
+    (key(params) is the partition key), with up to writers batches in flight.
+    Batches failing with a timeout are retried with exponential backoff,
+    so statements must be idempotent (plain inserts, not counters)."""
+    def __init__(self, session, writers=WRITERS, size=BATCH_SIZE, retries=RETRIES, backoff=BACKOFF, consistency=cql.ConsistencyLevel.QUORUM):
+        self.session = session
+        self.writers = writers
+        self.size = size
+        self.retries = retries
+        self.backoff = backoff
+        self.consistency = consistency
+        self.pending = deque()
+        self.timeouts = 0
+    def write(self, statement, params, key):
+        """Write all params, returns once every batch succeeded."""
+        groups = OrderedDict()
+        for p in params:
+            k = key(p)
+            if k not in groups:
+                groups[k] = []
+            groups[k].append(p)
+        for rows in groups.values():
+            for i in range(0, len(rows), self.size):
+                if len(rows) == 1:
+                    # lone row of its partition, skip batch overhead
+                    batch = statement.bind(rows[0])
+                    batch.consistency_level = self.consistency
+                else:
+                    batch = cql.BatchStatement(batch_type=cql.BatchType.UNLOGGED, consistency_level=self.consistency)
+                    for p in rows[i:i+self.size]:
+                        batch.add(statement, p)
+                self.pending.append((batch, self.session.execute_async(batch)))
+                while len(self.pending) >= self.writers:
+                    self._wait()
+        while len(self.pending) > 0:
+            self._wait()
+    def _wait(self):
+        batch, future = self.pending.popleft()
+        try:
+            future.result()
+            return
+        except RETRY_ERRORS:
+            self.timeouts += 1
+        # back off, cluster is overloaded
+        for attempt in range(self.retries):
+            time.sleep(min(MAX_SLEEP, self.backoff * (2 ** attempt)))
+            try:
+                self.session.execute(batch)
+                return
+            except RETRY_ERRORS:
+                self.timeouts += 1
+        raise IOError("batch failed after %d retries"%self.retries)
+
+def read_rows(path, offset=0, chunk=CHUNK_ROWS):
+    """Yield (rows, offset) for chunks of tab seperated lines starting at byte offset,
+    offset is the position after the last line of the chunk."""
+    with io.open(path, 'rb') as fh:
+        fh.seek(offset)
+        rows = []
+        while True:
+            line = fh.readline()
+            if not line:
+                break
+            line = line.decode('utf-8').rstrip('\r\n')
+            if line:
+                rows.append(line.split('\t'))
+            if len(rows) >= chunk:
+                yield rows, fh.tell()
+                rows = []
+        if rows:
+            yield rows, fh.tell()
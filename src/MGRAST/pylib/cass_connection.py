@@ -1,7 +1,8 @@
 
 import pika
+import threading
 from cassandra.cluster import Cluster
-from cassandra.policies import RetryPolicy
+from cassandra.policies import RetryPolicy, TokenAwarePolicy, DCAwareRoundRobinPolicy
 
 CASS_CLUSTER = None
 RMQ_CONN = None
@@ -13,7 +14,12 @@ RMQ_PROP = pika.BasicProperties(delivery_mode = 2)
 def create(hosts):
     global CASS_CLUSTER
     if not CASS_CLUSTER:
-        CASS_CLUSTER = Cluster(contact_points = hosts, default_retry_policy = RetryPolicy())
+        # token aware routing sends single partition statements straight to a replica
+        CASS_CLUSTER = Cluster(
+            contact_points = hosts,
+            default_retry_policy = RetryPolicy(),
+            load_balancing_policy = TokenAwarePolicy(DCAwareRoundRobinPolicy())
+        )
     return CASS_CLUSTER
 
 def destroy():
@@ -26,12 +32,43 @@ def destroy():
         RMQ_CONN.close()
     RMQ_CONN = None
 
+# in a forked worker, drop the parent's connections without closing them
+def forget():
+    global CASS_CLUSTER
+    global RMQ_CONN
+    CASS_CLUSTER = None
+    RMQ_CONN = None
+
 def rmqConnection():
     global RMQ_CONN
     if not RMQ_CONN:
         RMQ_CONN = pika.BlockingConnection(pika.ConnectionParameters(host=RMQ_HOST, credentials=RMQ_CRED))
     return RMQ_CONN
 
+class PreparedCache(object):
+    """Prepared statements of one session keyed by CQL text, with reuse counters."""
+    def __init__(self, session):
+        self.session = session
+        self.statements = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    def get(self, query):
+        stmt = self.statements.get(query)
+        if stmt is not None:
+            with self.lock:
+                self.hits += 1
+            return stmt
+        # concurrent misses may prepare twice, the driver returns the same statement id
+        stmt = self.session.prepare(query)
+        with self.lock:
+            self.statements[query] = stmt
+            self.misses += 1
+        return stmt
+    def stats(self):
+        with self.lock:
+            return {'statements': len(self.statements), 'hits': self.hits, 'misses': self.misses}
+
 class CassTest(object):
     def __init__(self, hosts, db):
         self.hosts = hosts
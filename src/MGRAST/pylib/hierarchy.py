@@ -0,0 +1,300 @@
+"""Versioned on-disk snapshot of the M5NR taxonomy and ontology hierarchies.
+
+The first caller for an M5NR version scans the hierarchy tables once and writes
+the snapshot, every later process loads it from disk. Names are interned into
+two string tables (taxonomy, ontology) and each map is stored as an int32
+numpy array indexed by name id, which is memory mapped on load.
+
+Array values: id of mapped name, NONE for a null value, ABSENT if the name
+is not a key of that map.
+
+A snapshot records the hierarchy stamp of the M5NR keyspace it was built from.
+The loader writes a new stamp when the hierarchy tables change, so snapshots
+on every host are rebuilt, and marks the version as loading meanwhile, when
+no snapshot is built from the partly loaded tables. A host without snapshot
+then reads the tables on every call, the result is neither kept nor written.
+"""
+
+import io
+import os
+import json
+import shutil
+import tempfile
+import datetime
+import numpy as np
+
+SNAPSHOT_DIR = os.environ.get('MGRAST_SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'm5nr_snapshot'))
+TAXA_LEVELS  = ['domain', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+ONT_LEVELS   = ['level1', 'level2', 'level3', 'level4']
+NONE   = -1
+ABSENT = -2
+
+# version : Hierarchy, loaded in this process
+LOADED = {}
+
+def snapshot_path(version):
+    return os.path.join(SNAPSHOT_DIR, "m5nr_v%d"%int(version))
+
+# identity of the snapshot files, changes when a snapshot is replaced
+def snapshot_id(path):
+    try:
+        st = os.stat(os.path.join(path, 'meta.json'))
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime)
+
+def get(version, scan, stamp=None, loading=False):
+    """Return Hierarchy for version, building the snapshot with scan(query) if missing
+    or built from another stamp. While loading an existing snapshot is used as is,
+    without one the tables are scanned into memory."""
+    version = int(version)
+    path = snapshot_path(version)
+    ident = snapshot_id(path)
+    loaded = LOADED.get(version)
+    if loaded and (ident is not None) and (loaded.identity == ident) and (loading or loaded.current(stamp)):
+        return loaded
+    if ident is not None:
+        loaded = Hierarchy(path)
+        if loading or loaded.current(stamp):
+            LOADED[version] = loaded
+            return loaded
+        # built from older tables
+        invalidate(version)
+    if loading:
+        return MemoryHierarchy(*scan_tables(scan))
+    build(version, scan, stamp)
+    LOADED[version] = Hierarchy(path)
+    return LOADED[version]
+
+def invalidate(version):
+    """Remove snapshot for version, next caller rebuilds it."""
+    version = int(version)
+    LOADED.pop(version, None)
+    path = snapshot_path(version)
+    if not os.path.isdir(path):
+        return
+    # move away first so readers never see a partial snapshot
+    trash = tempfile.mkdtemp(prefix='.trash_', dir=SNAPSHOT_DIR)
+    try:
+        os.rename(path, os.path.join(trash, 'old'))
+    except OSError:
+        pass
+    shutil.rmtree(trash, ignore_errors=True)
+
+class Namespace(object):
+    """Interns names into consecutive integer ids."""
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+    def code(self, name):
+        if name is None:
+            return NONE
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        return self.ids[name]
+    def array(self, found, width=None):
+        shape = (len(self.names), width) if width else (len(self.names),)
+        arr = np.full(shape, ABSENT, dtype=np.int32)
+        for k, v in found.items():
+            arr[k] = v
+        return arr
+    def write(self, path):
+        with io.open(path, 'w', encoding='utf-8', newline='\n') as fh:
+            for n in self.names:
+                fh.write(u"%s\n"%n)
+
+# (taxonomy, ontology, arrays, sources) of the hierarchy tables
+def scan_tables(scan):
+    taxonomy = Namespace()
+    ontology = Namespace()
+    arrays = {}
+
+    # organism : [ taxa levels ]
+    found = {}
+    for r in scan("SELECT * FROM organisms_ncbi"):
+        found[taxonomy.code(r['name'])] = [taxonomy.code(r['tax_'+t]) for t in TAXA_LEVELS]
+    taxa = found
+    # organism : taxa, per level
+    tax_maps = {}
+    for t in TAXA_LEVELS:
+        tname = "tax_"+t
+        found = {}
+        for r in scan("SELECT * FROM "+tname):
+            found[taxonomy.code(r['name'])] = taxonomy.code(r[tname])
+        tax_maps[tname] = found
+    # source : ontology : [ levels ]
+    ont_hier = {}
+    for r in scan("SELECT * FROM ontologies"):
+        if r['source'] not in ont_hier:
+            ont_hier[r['source']] = {}
+        ont_hier[r['source']][ontology.code(r['name'])] = [ontology.code(r[l]) for l in ONT_LEVELS]
+    # source : ontology : level, per level
+    ont_maps = {}
+    for l in ONT_LEVELS:
+        ont_maps[l] = {}
+        for r in scan("SELECT * FROM ont_"+l):
+            if r['source'] not in ont_maps[l]:
+                ont_maps[l][r['source']] = {}
+            ont_maps[l][r['source']][ontology.code(r['name'])] = ontology.code(r[l])
+    sources = set(ont_hier.keys())
+    for l in ONT_LEVELS:
+        sources.update(ont_maps[l].keys())
+    sources = sorted(sources)
+
+    # arrays are sized once all names are interned
+    arrays['taxa'] = taxonomy.array(taxa, len(TAXA_LEVELS))
+    for tname, found in tax_maps.items():
+        arrays[tname] = taxonomy.array(found)
+    for i, s in enumerate(sources):
+        arrays['ontologies.%d'%i] = ontology.array(ont_hier.get(s, {}), len(ONT_LEVELS))
+        for l in ONT_LEVELS:
+            arrays['ont_%s.%d'%(l, i)] = ontology.array(ont_maps[l].get(s, {}))
+    return taxonomy, ontology, arrays, sources
+
+def build(version, scan, stamp=None):
+    taxonomy, ontology, arrays, sources = scan_tables(scan)
+
+    # write to temp dir and move into place, first finished build wins
+    if not os.path.isdir(SNAPSHOT_DIR):
+        try:
+            os.makedirs(SNAPSHOT_DIR)
+        except OSError:
+            pass
+    tmp = tempfile.mkdtemp(prefix='.build_', dir=SNAPSHOT_DIR)
+    try:
+        taxonomy.write(os.path.join(tmp, 'taxonomy.names'))
+        ontology.write(os.path.join(tmp, 'ontology.names'))
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, name+'.npy'), arr)
+        meta = {
+            'version' : int(version),
+            'sources' : sources,
+            'stamp'   : stamp,
+            'built'   : datetime.datetime.now().isoformat()
+        }
+        with open(os.path.join(tmp, 'meta.json'), 'w') as fh:
+            json.dump(meta, fh)
+        try:
+            os.rename(tmp, snapshot_path(version))
+        except OSError:
+            pass
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+class CodedMap(object):
+    """Read-only mapping of name -> name (or list of names) backed by a coded array."""
+    def __init__(self, names, ids, array):
+        self.names = names
+        self.ids = ids
+        self.array = array
+        self.size = None
+    def code(self, name):
+        # row index of name or None
+        i = self.ids.get(name)
+        if (i is None) or (i >= len(self.array)):
+            return None
+        row = self.array[i]
+        if (row if self.array.ndim == 1 else row[0]) == ABSENT:
+            return None
+        return i
+    def decode(self, code):
+        if code < 0:
+            return None
+        return self.names[code]
+    def __contains__(self, name):
+        return self.code(name) is not None
+    def __getitem__(self, name):
+        i = self.code(name)
+        if i is None:
+            raise KeyError(name)
+        if self.array.ndim == 1:
+            return self.decode(int(self.array[i]))
+        return [self.decode(c) for c in self.array[i].tolist()]
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+    def rows(self):
+        present = self.array if self.array.ndim == 1 else self.array[:,0]
+        return np.nonzero(present != ABSENT)[0]
+    def __len__(self):
+        if self.size is None:
+            self.size = len(self.rows())
+        return self.size
+    def __iter__(self):
+        for i in self.rows():
+            yield self.names[i]
+    def keys(self):
+        return list(iter(self))
+    def items(self):
+        return [(k, self[k]) for k in self]
+    def to_dict(self):
+        return dict(self.items())
+
+class Hierarchy(object):
+    """Maps of a snapshot, arrays are memory mapped when first used."""
+    def __init__(self, path):
+        self.path = path
+        self.identity = snapshot_id(path)
+        with open(os.path.join(path, 'meta.json')) as fh:
+            self.meta = json.load(fh)
+        self.sources = self.meta['sources']
+        self.stamp = self.meta.get('stamp')
+        self.spaces = {}
+        self.arrays = {}
+    ## built from tables of stamp, any snapshot if the keyspace has no stamp
+    def current(self, stamp):
+        return (stamp is None) or (self.stamp == stamp)
+    def namespace(self, space):
+        # (names, ids) of taxonomy or ontology string table
+        if space not in self.spaces:
+            with io.open(os.path.join(self.path, space+'.names'), encoding='utf-8', newline='\n') as fh:
+                names = [n.rstrip(u'\n') for n in fh]
+            self.spaces[space] = (names, dict((n, i) for i, n in enumerate(names)))
+        return self.spaces[space]
+    def array(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = np.load(os.path.join(self.path, name+'.npy'), mmap_mode='r')
+        return self.arrays[name]
+    def coded(self, space, name):
+        names, ids = self.namespace(space)
+        return CodedMap(names, ids, self.array(name))
+    ## organism : [ domain, phylum, class, order, family, genus, species ]
+    def taxa_hierarchy(self):
+        return self.coded('taxonomy', 'taxa')
+    ## organism : taxa name at level
+    def org_taxa_map(self, taxa):
+        return self.coded('taxonomy', "tax_"+taxa.lower())
+    ## ontology : [ level1, level2, level3, level4 ], or source : map if no source
+    def ontology_hierarchy(self, source=None):
+        return self._by_source('ontologies', source)
+    ## ontology : name at level, or source : map if no source
+    def ontology_map(self, level, source=None):
+        return self._by_source('ont_'+level.lower(), source)
+    def _by_source(self, prefix, source):
+        if source:
+            if source not in self.sources:
+                return {}
+            return self.coded('ontology', '%s.%d'%(prefix, self.sources.index(source)))
+        found = {}
+        for i, s in enumerate(self.sources):
+            smap = self.coded('ontology', '%s.%d'%(prefix, i))
+            if len(smap) > 0:
+                found[s] = smap
+        return found
+
+class MemoryHierarchy(Hierarchy):
+    """Maps of scan_tables held in memory, not backed by a snapshot."""
+    def __init__(self, taxonomy, ontology, arrays, sources):
+        self.path = None
+        self.identity = None
+        self.meta = {'sources': sources}
+        self.sources = sources
+        self.stamp = None
+        self.spaces = {
+            'taxonomy' : (taxonomy.names, taxonomy.ids),
+            'ontology' : (ontology.names, ontology.ids)
+        }
+        self.arrays = arrays
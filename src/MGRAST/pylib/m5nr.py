@@ -1,12 +1,84 @@
 
+import io
+import time
+import uuid
+import hierarchy
 import cass_connection
+import cassandra
 import cassandra.query as cql
 
+# seconds a version stays marked as loading after its last taxonomy / ontology insert
+LOADING_TTL = 3600
+
+def read_babel(path, offset=0):
+    """Yield (md5, source, lines, end) for each group of consecutive lines of
+    a Babel .md52id2func / .md52id2ont file with the same md5 and source, starting
+    at byte offset. end is the offset after the group, a safe resume point.
+    Input must be sorted by md5 so each md5 forms one group."""
+    with io.open(path, 'rb') as fh:
+        fh.seek(offset)
+        key = None
+        lines = []
+        end = offset
+        while True:
+            line = fh.readline()
+            if not line:
+                break
+            parts = line.decode('utf-8').rstrip('\r\n').split('\t')
+            if len(parts) < 5:
+                end = fh.tell()
+                continue
+            curr = (parts[0], parts[4])
+            if curr != key:
+                if key:
+                    if curr[0] < key[0]:
+                        raise ValueError("%s is not sorted by md5 at byte %d"%(path, end))
+                    yield key[0], key[1], lines, end
+                key = curr
+                lines = []
+            lines.append(parts)
+            end = fh.tell()
+        if key:
+            yield key[0], key[1], lines, end
+
+def unique(values):
+    found = []
+    seen = set()
+    for v in values:
+        if v and (v not in seen):
+            seen.add(v)
+            found.append(v)
+    return found
+
+def annotation_row(md5, source, lines, kind='protein'):
+    """md5_annotation row of the columns a Babel file has, from the lines of one md5 and source.
+    kind is 'protein' or 'rna' for md52id2func lines, 'ontology' for md52id2ont lines.
+    func lines: md5, id, function, organism, source, ... -> ANNOTATION_INSERTS['protein' / 'rna']
+    ont lines:  md5, id, function, ontology, source      -> ANNOTATION_INSERTS['ontology']
+    single and lca are not in Babel files and never bound, empty lists are unset
+    so a reload does not overwrite existing values with tombstones"""
+    functions = unique(l[2] for l in lines) or cql.UNSET_VALUE
+    if kind == 'ontology':
+        return [md5, source, unique(l[3] for l in lines) or cql.UNSET_VALUE, functions]
+    organisms = unique(l[3] for l in lines) or cql.UNSET_VALUE
+    return [md5, source, kind != 'rna', unique(l[1] for l in lines), functions, organisms]
+
+# md5_annotation inserts of annotation_row kinds
+ANNOTATION_INSERTS = {
+    'protein'  : "INSERT INTO md5_annotation (md5, source, is_protein, accession, function, organism) VALUES (?, ?, ?, ?, ?, ?)",
+    'rna'      : "INSERT INTO md5_annotation (md5, source, is_protein, accession, function, organism) VALUES (?, ?, ?, ?, ?, ?)",
+    'ontology' : "INSERT INTO md5_annotation (md5, source, accession, function) VALUES (?, ?, ?, ?)"
+}
+
 class M5nrUpload(object):
     def __init__(self, hosts, version):
+        self.version = int(version)
         self.keyspace = "m5nr_v"+str(version)
         self.session = cass_connection.create(hosts).connect()
         self.session.default_timeout = 300
+        self.prepared = cass_connection.PreparedCache(self.session)
+        self.keyspace_set = False
+        self.hierarchy_marked = 0 # time of last loading mark
         self.inserts = {
             "annotation.midx"  : "INSERT INTO midx_annotation (md5, source, is_protein, single, accession, function, organism) VALUES (?, ?, ?, ?, ?, ?, ?)",
             "annotation.md5"   : "INSERT INTO md5_annotation (md5, source, is_protein, single, lca, accession, function, organism) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
@@ -29,16 +101,38 @@ class M5nrUpload(object):
     def close(self):
         cass_connection.destroy()
     
+    def useKeyspace(self):
+        if not self.keyspace_set:
+            self.session.set_keyspace(self.keyspace)
+            self.keyspace_set = True
+    
+    ## prepared insert statement for table name
+    def insertStatement(self, table):
+        self.useKeyspace()
+        return self.prepared.get(self.inserts[table])
+    
+    ## prepared md5_annotation insert for annotation_row of kind
+    def annotationStatement(self, kind):
+        self.useKeyspace()
+        return self.prepared.get(ANNOTATION_INSERTS[kind])
+    
     def batchInsert(self, table, data):
-        self.session.set_keyspace(self.keyspace)
+        self.useKeyspace()
         
         # fix booleans
         if (table == "annotation.midx") or (table == "annotation.md5"):
             for i in range(len(data)):
                 data[i][2] = True if data[i][2] == 1 else False
         
-        cmd = self.inserts[table]
-        insert = self.session.prepare(cmd)
+        # no hierarchy snapshot is built until finishHierarchy, or LOADING_TTL after the last insert
+        if (table.startswith("taxonomy.") or table.startswith("ontology.")) and ((time.time() - self.hierarchy_marked) > (LOADING_TTL / 2)):
+            try:
+                self.markHierarchy(True)
+            except Exception as ex:
+                return "unable to mark hierarchy loading: an exception of type {0} occured. Arguments:\n{1!r}".format(type(ex).__name__, ex.args)
+            self.hierarchy_marked = time.time()
+        
+        insert = self.insertStatement(table)
         if len(data) == 1:
             try:
                 self.session.execute(insert, data[0])
@@ -54,10 +148,38 @@ class M5nrUpload(object):
                 return "unable to insert data: an exception of type {0} occured. Arguments:\n{1!r}".format(type(ex).__name__, ex.args)
         return ""
     
-    def createNewM5nr(self):
+    ## new hierarchy stamp, snapshots of other stamps are rebuilt on every host.
+    ## the loading mark expires LOADING_TTL seconds after the last insert, if finishHierarchy is never called.
+    ## keyspaces created before hierarchy_stamp have no stamp, only the local snapshot is dropped
+    def markHierarchy(self, loading):
+        self.useKeyspace()
+        try:
+            stamp = self.prepared.get("UPDATE hierarchy_stamp SET stamp = ? WHERE version = ?")
+            mark = self.prepared.get("UPDATE hierarchy_stamp USING TTL ? SET loading = ? WHERE version = ?")
+        except cassandra.InvalidRequest:
+            return
+        batch = cql.BatchStatement(consistency_level=cql.ConsistencyLevel.QUORUM)
+        batch.add(stamp, (uuid.uuid4().hex, self.version))
+        batch.add(mark, (LOADING_TTL if loading else 0, loading, self.version))
+        self.session.execute(batch)
+    
+    ## end of taxonomy / ontology load, snapshots are rebuilt from the loaded tables
+    def finishHierarchy(self):
+        try:
+            self.markHierarchy(False)
+        except Exception as ex:
+            return "unable to finish hierarchy: an exception of type {0} occured. Arguments:\n{1!r}".format(type(ex).__name__, ex.args)
+        hierarchy.invalidate(self.version)
+        return ""
+    
+    def hasKeyspace(self):
         rows = self.session.execute("SELECT keyspace_name FROM system_schema.keyspaces")
-        if self.keyspace in [row[0] for row in rows]:
+        return self.keyspace in [row[0] for row in rows]
+    
+    def createNewM5nr(self):
+        if self.hasKeyspace():
             return "unable to complete: a keyspace already exists for the given M5NR version number"
+        hierarchy.invalidate(self.version)
         
         try:
             # create keyspace
@@ -66,11 +188,15 @@ class M5nrUpload(object):
                 WITH replication = { 'class': 'SimpleStrategy', 'replication_factor': '3' }
                 """ %(self.keyspace)
             )
-            self.session.set_keyspace(self.keyspace)
+            self.useKeyspace()
         except Exception as ex:
             return "unable to create keyspace: an exception of type {0} occured. Arguments:\n{1!r}".format(type(ex).__name__, ex.args)
-        
-        try:    
+        return self.createTables()
+    
+    ## tables of the version keyspace, existing tables are kept
+    def createTables(self):
+        try:
+            self.useKeyspace()
             # create tables
             self.session.execute("""
             CREATE TABLE IF NOT EXISTS midx_annotation (
@@ -241,6 +367,15 @@ class M5nrUpload(object):
             )
             WITH compaction = { 'class': 'LeveledCompactionStrategy' };
             """)
+
+            self.session.execute("""
+            CREATE TABLE IF NOT EXISTS hierarchy_stamp (
+                version int,
+                stamp text,
+                loading boolean,
+                PRIMARY KEY (version)
+            );
+            """)
         except Exception as ex:
             return "unable to create tables: an exception of type {0} occured. Arguments:\n{1!r}".format(type(ex).__name__, ex.args)
         return ""
@@ -1,16 +1,25 @@
 
 import sys
-import time
 import datetime
 import json
+import array
+import multiprocessing
 import shock
-import operator
+import progress
+import numpy as np
+import mgrast_biom
+import cass_connection
 import mgrast_cassandra
-from collections import defaultdict
+from collections import OrderedDict
 
-UPDATE_SECS  = 300
-M5NR_VERSION = 1
-CHUNK_SIZE = 100
+UPDATE_SECS   = 300
+M5NR_VERSION  = 1
+CHUNK_SIZE    = 100
+LOOKUP_WINDOW = 8
+FLUSH_SIZE    = 65536
+PROCESSES     = 1
+DEDUP_RECORDS = 1000000
+LOOKUP_REPORT = 10
 TAXONOMY   = ['domain', 'phylum', 'class', 'order', 'family', 'genus', 'species', 'strain']
 RESULT_MAP = {
     'abundance' : 'abundance',
@@ -19,25 +28,199 @@ RESULT_MAP = {
     'identity'  : 'ident_avg'
 }
 
+class Accumulator(object):
+    """Accumulates matrix cells into growable numpy arrays with one row per annotation.
+    Values are buffered and scatter-added in bulk, counts are only kept for averages."""
+    def __init__(self, columns, rtype, capacity=1024):
+        self.columns = columns
+        self.average = rtype != 'abundance'
+        self.row_idx = {} # row_id : row_idx
+        self.row_ids = []
+        self.sums = np.zeros((capacity, columns), dtype=np.float64 if self.average else np.int64)
+        self.counts = np.zeros((capacity, columns), dtype=np.int64) if self.average else None
+        self.pending = ([], [], []) # row_idx, col_idx, value
+    
+    def row(self, row_id):
+        if row_id in self.row_idx:
+            return self.row_idx[row_id]
+        rindex = len(self.row_ids)
+        if rindex == len(self.sums):
+            self.sums = self._grow(self.sums)
+            if self.average:
+                self.counts = self._grow(self.counts)
+        self.row_idx[row_id] = rindex
+        self.row_ids.append(row_id)
+        return rindex
+    
+    def add(self, rindex, cindex, value):
+        self.pending[0].append(rindex)
+        self.pending[1].append(cindex)
+        self.pending[2].append(value)
+        if len(self.pending[0]) >= FLUSH_SIZE:
+            self.flush()
+    
+    def flush(self):
+        if len(self.pending[0]) == 0:
+            return
+        cells = (np.array(self.pending[0], dtype=np.intp), np.array(self.pending[1], dtype=np.intp))
+        np.add.at(self.sums, cells, np.array(self.pending[2], dtype=self.sums.dtype))
+        if self.average:
+            np.add.at(self.counts, cells, 1)
+        self.pending = ([], [], [])
+    
+    def nonzero(self):
+        self.flush()
+        return int(np.count_nonzero(self.sums[:len(self.row_ids)]))
+    
+    # abundance: sum, other: average rounded to 3 places, 0 if no values
+    def dense(self):
+        self.flush()
+        nrows = len(self.row_ids)
+        if not self.average:
+            return self.sums[:nrows].tolist()
+        data = []
+        for srow, crow in zip(self.sums[:nrows].tolist(), self.counts[:nrows].tolist()):
+            data.append([ round((s / c), 3) if c else 0 for s, c in zip(srow, crow) ])
+        return data
+    
+    # [ row, column, value ] for non-zero cells, in row order
+    def sparse(self):
+        self.flush()
+        nrows = len(self.row_ids)
+        ridx, cidx = np.nonzero(self.sums[:nrows])
+        sums = self.sums[ridx, cidx].tolist()
+        if not self.average:
+            return [ [r, c, s] for r, c, s in zip(ridx.tolist(), cidx.tolist(), sums) ]
+        data = []
+        counts = self.counts[ridx, cidx].tolist()
+        for r, c, s, n in zip(ridx.tolist(), cidx.tolist(), sums, counts):
+            value = round((s / n), 3)
+            if value:
+                data.append([r, c, value])
+        return data
+    
+    # replay cells of a Partial, in the order they were added
+    def merge(self, part):
+        rows = [ self.row(r) for r in part.row_ids ]
+        self.pending[0].extend([ rows[r] for r in part.cells[0] ])
+        self.pending[1].extend(part.cells[1])
+        self.pending[2].extend(part.cells[2])
+        if len(self.pending[0]) >= FLUSH_SIZE:
+            self.flush()
+    
+    def _grow(self, arr):
+        grown = np.zeros((len(arr) * 2, self.columns), dtype=arr.dtype)
+        grown[:len(arr)] = arr
+        return grown
+
+class Partial(object):
+    """Records rows and cells of one part of a column in order, same interface as Accumulator.
+    Merging partials in scan order gives the same matrix as accumulating directly."""
+    def __init__(self):
+        self.row_idx = {} # row_id : row_idx
+        self.row_ids = []
+        self.cells = ([], [], []) # row_idx, col_idx, value
+    
+    def row(self, row_id):
+        if row_id not in self.row_idx:
+            self.row_idx[row_id] = len(self.row_ids)
+            self.row_ids.append(row_id)
+        return self.row_idx[row_id]
+    
+    def add(self, rindex, cindex, value):
+        self.cells[0].append(rindex)
+        self.cells[1].append(cindex)
+        self.cells[2].append(value)
+    
+    # row_idx is not needed once recorded
+    def __getstate__(self):
+        return (self.row_ids, self.cells)
+    
+    def __setstate__(self, state):
+        self.row_ids, self.cells = state
+        self.row_idx = None
+
+# set row metadata from the first hierarchy entry whose hier_match field is the row id.
+# entries are indexed once and copied, the caller's hierarchy is not changed
+def join_hierarchy(rows, hierarchy, hier_match):
+    index = {}
+    for h in hierarchy:
+        if (hier_match in h) and (h[hier_match] not in index):
+            index[h[hier_match]] = h
+    for r in rows:
+        if r['id'] not in index:
+            continue
+        h = dict(index[r['id']])
+        if 'organism' in h:
+            h['strain'] = h.pop('organism')
+        h.pop('accession', None)
+        if 'ncbi_tax_id' in h:
+            tid = h.pop('ncbi_tax_id')
+            r['metadata'] = { 'hierarchy': h, 'ncbi_tax_id': tid }
+        else:
+            r['metadata'] = { 'hierarchy': h }
+    return rows
+
+# Matrix of a worker process, parts of job scans are built in a pool
+WORKER = None
+
+def init_worker(hosts, version, chunk, window, ontology):
+    global WORKER
+    cass_connection.forget()
+    WORKER = Matrix(hosts, version, chunk, window)
+    WORKER.set_ontology(ontology)
+
+def run_part(task):
+    cindex, segment, param = task
+    group_map, filter_list = WORKER.part_maps(param)
+    part = Partial()
+    total = WORKER.column_part(cindex, WORKER.jobs.scan_segment(segment), param, group_map, filter_list, part)
+    return total, part
+
 class Matrix(object):
-    def __init__(self, hosts, version=M5NR_VERSION, chunk=CHUNK_SIZE):
+    def __init__(self, hosts, version=M5NR_VERSION, chunk=CHUNK_SIZE, window=LOOKUP_WINDOW, processes=PROCESSES):
         self.m5nr = mgrast_cassandra.M5nrHandle(hosts, version)
         self.jobs = mgrast_cassandra.JobHandle(hosts, version)
+        self.hosts = hosts
         self.chunk = int(chunk)
         self.shock = None
+        self.reporter = None
+        self.maps = {}
         self.version = int(version)
         self.set_ontology()
+        self.set_window(window)
+        self.set_processes(processes)
     
     def set_ontology(self, sources=['Subsystems', 'NOG', 'COG', 'KO']):
         self.ontology = sources
     
+    # number of annotation lookups kept in flight while scanning job rows
+    def set_window(self, window=LOOKUP_WINDOW):
+        self.window = int(window)
+    
+    # number of worker processes columns are built in concurrently, 1 builds in this process
+    def set_processes(self, processes=PROCESSES):
+        self.processes = max(1, int(processes))
+    
     def set_shock(self, token=None, bearer='mgrast', url='http://shock.mg-rast.org'):
         self.shock = shock.ShockClient(shock_url=url, bearer=bearer, token=token)
     
     def close(self):
+        if self.reporter:
+            self.reporter.stop()
+        self.log_shock()
         self.m5nr.close()
         self.jobs.close()
     
+    # shock request counters of the build, logged once when it closes
+    def log_shock(self):
+        if self.shock is None:
+            return
+        stats = self.shock.get_stats()
+        if stats['requests'] > 0:
+            mgrast_cassandra.rmqLogger(self.jobs.channel, 'shock', self.shock.shock_url, stats=stats)
+        self.shock.reset_stats()
+    
     def compute_matrix(self, node, param, metadata, hierarchy):
         matrix = None
         ## compute matrix
@@ -46,21 +229,22 @@ class Matrix(object):
             for mg in param['mg_ids']:
                 mdata = metadata[mg] if mg in metadata else None
                 matrix['columns'].append({'id': mg, 'metadata': mdata})
-            rows, data = self.get_data(node, param, hierarchy)
+            rows, data, mtype = self.get_data(node, param, hierarchy)
             matrix['rows']  = rows
             matrix['data']  = data
             matrix['shape'] = [ len(matrix['rows']), len(matrix['columns']) ]
+            matrix['matrix_type'] = mtype
         except Exception as ex:
             self.error_exit("unable to build BIOM matrix", node, ex)
             return
         
         ## sanity check
-        if len(matrix['data']) == 0:
+        if len(matrix['rows']) == 0:
             self.error_exit("no data returned for the given parameters, try again with lower cutoffs (evalue, identity, length)", node)
             return
         
         ## store file in node
-        self.shock.upload(node=node['id'], data=json.dumps(matrix), file_name=param['id']+".biom")
+        self.shock.upload_json(node=node['id'], obj=matrix, file_name=param['id']+".biom")
         return None
     
     def error_exit(self, error, node=None, ex=None):
@@ -97,143 +281,270 @@ class Matrix(object):
     
     def get_data(self, node, param, hierarchy): 
         found = 0
-        data  = []
-        to_swap = True if ('swaps' in param) and (len(param['swaps']) == len(param['job_ids'])) else False
         row_len = len(param['job_ids'])
-        row_idx = {} # row_id : row_idx
-        md5_val = {} # md5 : value
+        matrix  = Accumulator(row_len, param['result_type'])
         # group_map = None if not leaf_node
-        group_map = self.get_group_map(param['type'], param['hit_type'], param['group_level'], param['leaf_node'], param['source'])
         # filter_list = None if not leaf_filter and no filter text
-        filter_list = self.get_filter_list(param['type'], param['filter'], param['filter_level'], param['filter_source'], param['leaf_filter'])
-        
-        def append_matrix(cindex, md5_val, found, data, row_idx):
-            next_idx = len(row_idx) # incraments row idx
-            # get filter md5s / skip empty
-            if filter_list and param['filter_source']:
-                qmd5s = self.get_filter_md5s(md5_val.keys(), param['type'], filter_list, param['filter_source'])
-            else:
-                qmd5s = md5_val.keys()
-            if len(qmd5s) == 0:
-                return found, data, row_idx
-            
-            ann_data = self.m5nr.get_records_by_md5(qmd5s, source=param['source'], index=False, iterator=True)
-            for info in ann_data:                
-                # get annotations based on type & hit_type
-                # one of type: organism, function, accession, single
-                annotations = [];
-                if param['type'] == 'function':
-                    annotations = info['function']
-                elif param['type'] == 'ontology':
-                    annotations = info['accession']
-                elif param['type'] == 'organism':
-                    if param['hit_type'] == 'all':
-                        annotations = info['organism']
-                    elif param['hit_type'] == 'single':
-                        annotations = [ info['single'] ];
-                    elif param['hit_type'] == 'lca':
-                        try:
-                            taxa = info['lca'][group_map]
-                            if taxa.startswith('-'):
-                                continue
-                            annotations = [ taxa ]
-                        except Exception:
-                            continue
-                # grouping
-                if group_map and (param['hit_type'] != 'lca'):
-                    unique = set()
-                    for a in annotations:
-                        if a in group_map:
-                            unique.add(group_map[a])
-                    annotations = list(unique)
-                # loop through annotations for row index
-                for a in annotations:
-                    if a in row_idx:
-                        # alrady saw this annotation
-                        rindex = row_idx[a]
-                    else:
-                        # new annotation, add to rows
-                        rindex = next_idx
-                        row_idx[a] = rindex
-                        if param['result_type'] == 'abundance':
-                            # populate data with zero's
-                            data.append([0 for _ in range(row_len)])
-                        else:
-                            # populate data with tuple of zero's
-                            data.append([(0,0) for _ in range(row_len)])
-                        next_idx += 1
-                    # get md5 value for job
-                    # curr is int if abundance, tuple otherwise
-                    if info['md5'] in md5_val:
-                        curr = data[rindex][cindex]
-                        data[rindex][cindex] = self.add_value(curr, md5_val[info['md5']], param['result_type'])
-            return found, data, row_idx
+        group_map, filter_list = self.part_maps(param)
         
         # loop through jobs
-        for cindex, job in enumerate(param['job_ids']):
-            col_name = RESULT_MAP[param['result_type']]
-            swap_job = False
-            if to_swap and param['swaps'][cindex]:
-                swap_job = True
-                if col_name == 'len_avg':
-                    col_name = 'ident_avg'
-                elif col_name == 'ident_avg':
-                    col_name = 'len_avg'
-            total = 0
-            count = 0
-            prev  = time.time()
-            recs  = self.jobs.get_job_records(job, ['md5', col_name], swap_job, param['evalue'], param['identity'], param['length'])
-            # loop through md5 values
-            for r in recs:
-                md5_val[r[0]] = r[1]
-                total += 1
-                count += 1
-                if count == self.chunk:
-                    found, data, row_idx = append_matrix(cindex, md5_val, found, data, row_idx)
-                    md5_val = {}
-                    count = 0
-                if (total % 1000) == 0:
-                    prev = self.update_progress(node, job, total, found, prev)
-            if count > 0:
-                found, data, row_idx = append_matrix(cindex, md5_val, found, data, row_idx)
-            prev = self.update_progress(node, job, total, found, 0) # last update for this job
+        pool = self.start_pool() if self.processes > 1 else None
+        reporter = self.start_progress(node)
+        if pool:
+            self.merge_columns(matrix, param, reporter, pool)
+        elif (row_len > 1) and (self.dedup_limit(param) > 0):
+            self.dedup_columns(matrix, param, group_map, filter_list, reporter, self.dedup_limit(param))
+        else:
+            for cindex, job in enumerate(param['job_ids']):
+                fields, swap_job = self.column_fields(cindex, param)
+                recs  = self.jobs.get_job_records(job, fields, swap_job, param['evalue'], param['identity'], param['length'])
+                total = self.column_part(cindex, recs, param, group_map, filter_list, matrix, reporter, job)
+                reporter.report(self.progress_values(total, found, None, 1), job) # last update for this job
+        reporter.close()
         
-        # transform [ count, sum ] to single average
-        if param['result_type'] != 'abundance':
-            for row in data:
-                for i in range(row_len):
-                    (n, s) = row[i]
-                    if n == 0:
-                        row[i] = 0
-                    else:
-                        row[i] = round((s / n), 3)
+        # sums, or averages of [ count, sum ]
+        # sparse unless requested otherwise or too many cells are filled
+        mtype = mgrast_biom.matrix_type(matrix.nonzero(), len(matrix.row_ids), row_len, param.get('matrix_type'))
+        data = matrix.sparse() if mtype == 'sparse' else matrix.dense()
         
         # build rows
         rows = []
-        for r, i in sorted(row_idx.items(), key=operator.itemgetter(1)):
+        for r in matrix.row_ids:
             rows.append({'id' : r, 'metadata' : None})
             
         # add row metadata / hierarchy
         if param['hier_match'] and (len(hierarchy) > 0):
-            for r in rows:
-                for h in hierarchy:
-                    if param['hier_match'] not in h:
-                        continue
-                    if r['id'] == h[param['hier_match']]:
-                        if 'organism' in h:
-                            h['strain'] = h['organism']
-                            del h['organism']
-                        if 'accession' in h:
-                            del h['accession']
-                        if 'ncbi_tax_id' in h:
-                            tid = h['ncbi_tax_id']
-                            del h['ncbi_tax_id']
-                            r['metadata'] = { 'hierarchy': h, 'ncbi_tax_id': tid }
-                        else:
-                            r['metadata'] = { 'hierarchy': h }
-                        break
+            join_hierarchy(rows, hierarchy, param['hier_match'])
         # done
-        return rows, data
+        return rows, data, mtype
+    
+    # job fields and swap of column
+    def column_fields(self, cindex, param):
+        to_swap = True if ('swaps' in param) and (len(param['swaps']) == len(param['job_ids'])) else False
+        col_name = RESULT_MAP[param['result_type']]
+        swap_job = False
+        if to_swap and param['swaps'][cindex]:
+            swap_job = True
+            if col_name == 'len_avg':
+                col_name = 'ident_avg'
+            elif col_name == 'ident_avg':
+                col_name = 'len_avg'
+        return ['md5', col_name], swap_job
+    
+    # add md5 records of column to target (Accumulator or Partial), returns number of records
+    def column_part(self, cindex, recs, param, group_map, filter_list, target, reporter=None, job=None):
+        found = 0
+        md5_val = OrderedDict() # md5 : value
+        lookups = mgrast_cassandra.LookupPipeline(self.m5nr, source=param['source'], index=False, window=self.window)
+        
+        def submit_chunk(cindex, md5_val):
+            qmd5s = list(md5_val.keys())
+            return lookups.submit(qmd5s, (cindex, md5_val, self.submit_filter(qmd5s, param, filter_list)))
+        
+        def append_matrix(chunk, ann_data, found):
+            cindex, md5_val, ffuture = chunk
+            if filter_list and param['filter_source']:
+                ann_data = self.filter_records(ann_data, ffuture, param['type'], filter_list)
+            for info in ann_data:
+                annotations = self.row_annotations(info, param, group_map)
+                if annotations is None:
+                    continue
+                # loop through annotations for row index, new annotations add a row
+                for a in annotations:
+                    rindex = target.row(a)
+                    # add md5 value for job
+                    if info['md5'] in md5_val:
+                        target.add(rindex, cindex, md5_val[info['md5']])
+            return found
+        
+        total = 0
+        count = 0
+        # loop through md5 values
+        for r in recs:
+            md5_val[r[0]] = r[1]
+            total += 1
+            count += 1
+            if count == self.chunk:
+                for chunk, ann_data in submit_chunk(cindex, md5_val):
+                    found = append_matrix(chunk, ann_data, found)
+                md5_val = OrderedDict()
+                count = 0
+            if reporter and ((total % 1000) == 0):
+                reporter.report(self.progress_values(total, found, lookups), job)
+        if count > 0:
+            for chunk, ann_data in submit_chunk(cindex, md5_val):
+                found = append_matrix(chunk, ann_data, found)
+        for chunk, ann_data in lookups.drain():
+            found = append_matrix(chunk, ann_data, found)
+        if reporter:
+            reporter.report(self.progress_values(total, found, lookups), job)
+        return total
+    
+    # row ids of annotation record, None to skip record
+    def row_annotations(self, info, param, group_map):
+        # get annotations based on type & hit_type
+        # one of type: organism, function, accession, single
+        annotations = [];
+        if param['type'] == 'function':
+            annotations = info['function']
+        elif param['type'] == 'ontology':
+            annotations = info['accession']
+        elif param['type'] == 'organism':
+            if param['hit_type'] == 'all':
+                annotations = info['organism']
+            elif param['hit_type'] == 'single':
+                annotations = [ info['single'] ];
+            elif param['hit_type'] == 'lca':
+                try:
+                    taxa = info['lca'][group_map]
+                    if taxa.startswith('-'):
+                        return None
+                    annotations = [ taxa ]
+                except Exception:
+                    return None
+        # grouping
+        if group_map and (param['hit_type'] != 'lca'):
+            unique = set()
+            for a in annotations:
+                if a in group_map:
+                    unique.add(group_map[a])
+            annotations = list(unique)
+        return annotations
+    
+    # job records held by dedup_columns at once, param 'dedup' overrides, 0 turns dedup off
+    def dedup_limit(self, param):
+        limit = param.get('dedup')
+        return DEDUP_RECORDS if limit is None else int(limit)
+    
+    # scan columns until limit records are held, also within a column, resolve annotations
+    # of each distinct md5 of that group once, then add values to its columns in scan order,
+    # same result as column by column
+    def dedup_columns(self, matrix, param, group_map, filter_list, reporter, limit):
+        md5_ids = {} # md5 : id
+        columns = [] # ( cindex, job, md5 ids, values, records and saved lookups of job so far, end of job ) in scan order
+        held    = 0
+        for cindex, job in enumerate(param['job_ids']):
+            fields, swap_job = self.column_fields(cindex, param)
+            ids   = array.array('l')
+            vals  = array.array('d')
+            queried, saved = 0, 0
+            for r in self.jobs.get_job_records(job, fields, swap_job, param['evalue'], param['identity'], param['length']):
+                if held >= limit:
+                    # group is full, rest of the column goes into the next one
+                    columns.append((cindex, job, ids, vals, queried, saved, False))
+                    self.dedup_group(matrix, param, group_map, filter_list, reporter, md5_ids, columns)
+                    md5_ids, columns, held = {}, [], 0
+                    ids  = array.array('l')
+                    vals = array.array('d')
+                i = md5_ids.get(r[0])
+                if i is None:
+                    i = len(md5_ids)
+                    md5_ids[r[0]] = i
+                else:
+                    saved += 1
+                ids.append(i)
+                vals.append(r[1])
+                held += 1
+                queried += 1
+                if (queried % 1000) == 0:
+                    reporter.report(self.progress_values(queried, 0), job)
+            columns.append((cindex, job, ids, vals, queried, saved, True))
+        if columns:
+            self.dedup_group(matrix, param, group_map, filter_list, reporter, md5_ids, columns)
+    
+    def dedup_group(self, matrix, param, group_map, filter_list, reporter, md5_ids, columns):
+        md5s = [ None ] * len(md5_ids) # id : md5
+        for md5, i in md5_ids.items():
+            md5s[i] = md5
+        # md5 id : [ row ids ], None if not annotated or filtered
+        annotations = [ None ] * len(md5s)
+        lookups = mgrast_cassandra.LookupPipeline(self.m5nr, source=param['source'], index=False, window=self.window)
+        
+        def resolve(ffuture, ann_data):
+            if filter_list and param['filter_source']:
+                ann_data = self.filter_records(ann_data, ffuture, param['type'], filter_list)
+            for info in ann_data:
+                found = self.row_annotations(info, param, group_map)
+                if found is None:
+                    continue
+                i = md5_ids[info['md5']]
+                if annotations[i] is None:
+                    annotations[i] = []
+                annotations[i].extend(found)
+        
+        # lookups are shared by the jobs of the group, reported under each of them
+        def report():
+            for cindex, job, ids, vals, queried, saved, last in columns:
+                reporter.report(self.progress_values(queried, 0, lookups), job)
+        
+        for start in range(0, len(md5s), self.chunk):
+            chunk = md5s[start:start+self.chunk]
+            for ffuture, ann_data in lookups.submit(chunk, self.submit_filter(chunk, param, filter_list)):
+                resolve(ffuture, ann_data)
+            if ((start // self.chunk) % LOOKUP_REPORT) == 0:
+                report()
+        for ffuture, ann_data in lookups.drain():
+            resolve(ffuture, ann_data)
+        md5s = None
+        
+        # scatter values into columns
+        for c, (cindex, job, ids, vals, queried, saved, last) in enumerate(columns):
+            for i, v in zip(ids, vals):
+                if annotations[i]:
+                    for a in annotations[i]:
+                        matrix.add(matrix.row(a), cindex, v)
+            columns[c] = None
+            if last:
+                reporter.report(self.progress_values(queried, 0, None, 1, saved), job) # last update for this job
+            else:
+                reporter.report(self.progress_values(queried, 0, None, None, saved), job)
+    
+    # group map and filter list of param, kept for reuse by worker processes
+    def part_maps(self, param):
+        gkey = ('group', param['type'], param['hit_type'], param['group_level'], param['leaf_node'], param['source'])
+        fkey = ('filter', param['type'], param['filter'], param['filter_level'], param['filter_source'], param['leaf_filter'])
+        if gkey not in self.maps:
+            self.maps[gkey] = self.get_group_map(param['type'], param['hit_type'], param['group_level'], param['leaf_node'], param['source'])
+        if fkey not in self.maps:
+            flist = self.get_filter_list(param['type'], param['filter'], param['filter_level'], param['filter_source'], param['leaf_filter'])
+            self.maps[fkey] = set(flist) if flist else flist
+        return self.maps[gkey], self.maps[fkey]
+    
+    # workers are forked before the progress thread starts, a fork while it
+    # holds a lock would leave that lock held in the worker
+    def start_pool(self):
+        if self.reporter:
+            self.reporter.stop()
+        return multiprocessing.Pool(self.processes, initializer=init_worker, initargs=(self.hosts, self.version, self.chunk, self.window, self.ontology))
+    
+    # all columns are built concurrently in the pool, each as one or more md5 range parts.
+    # partials are merged in column then range order, ranges concatenate to the sequential
+    # scan, so the merged matrix is identical to the sequential one
+    def merge_columns(self, matrix, param, reporter, pool):
+        jobs  = param['job_ids']
+        parts = max(1, -(-self.processes // len(jobs))) # split jobs only if fewer than processes
+        tasks = []
+        owner = [] # (job, is last part of job)
+        total = 0
+        try:
+            for cindex, job in enumerate(jobs):
+                fields, swap_job = self.column_fields(cindex, param)
+                segments = self.jobs.record_segments(job, 'md5', fields, parts, swap_job, param['evalue'], param['identity'], param['length'])
+                for i, seg in enumerate(segments):
+                    tasks.append((cindex, seg, param))
+                    owner.append((job, i == (len(segments) - 1)))
+            for (job, last), (ptotal, part) in zip(owner, pool.imap(run_part, tasks)):
+                total += ptotal
+                matrix.merge(part)
+                if last:
+                    reporter.report(self.progress_values(total, 0, None, 1), job) # last update for this job
+                    total = 0
+                else:
+                    reporter.report(self.progress_values(total, 0), job)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
     
     # get grouping map: leaf_name => group_name
     # index of taxonomy if lca
@@ -260,39 +571,36 @@ class Matrix(object):
                 return self.m5nr.get_organism_by_taxa(flevel, ftext)
         return None
     
-    # get subset of md5s based on filter list / source
-    def get_filter_md5s(self, md5s, mtype, flist, fsource):
-        fmd5s = []
+    # filter source lookup sent alongside the annotation lookup of md5s, None if not needed.
+    # when filter source is the annotation source the annotation records are filtered directly
+    def submit_filter(self, md5s, param, flist):
+        if flist and param['filter_source'] and (param['filter_source'] != param['source']):
+            return self.m5nr.get_records_by_md5_async(md5s, source=param['filter_source'], index=False)
+        return None
+    
+    # annotation records whose md5 matches filter set, tested on filter records if given
+    def filter_records(self, records, ffuture, mtype, flist):
         field = 'accession' if mtype == 'ontology' else 'organism'
-        recs  = self.m5nr.get_records_by_md5(md5s, source=fsource, index=False, iterator=True)
-        for r in recs:
-            for a in r[field]:
-                if a in flist:
-                    fmd5s.append(r['md5'])
-        return fmd5s
-    
-    # sum if abundance, [ count, sum ] if other
-    def add_value(self, curr, val, rtype):
-        if rtype == 'abundance':
-            # return sum
-            return curr + val
-        else:
-            # return tuple of count, sum
-            return ( curr[0]+1, curr[1]+val )
-    
-    # only update if been more than UPDATE_SECS
-    def update_progress(self, node, job, total, found, prev):
-        now = time.time()
-        if self.shock and node and (now > (prev + UPDATE_SECS)):
-            attr = node['attributes']
-            if job in attr['progress']:
-                attr['progress'][job]['queried'] = total
-                attr['progress'][job]['found'] = found
-                if prev == 0:
-                    # final update
-                    attr['progress'][job]['completed'] = 1
-            self.shock.upload(node=node['id'], attr=json.dumps(attr))
-            return now
-        else:
-            return prev
+        match = lambda r: any((a in flist) for a in r[field])
+        if ffuture is None:
+            return [r for r in records if match(r)]
+        keep = set(r['md5'] for r in ffuture.result() if match(r))
+        return [r for r in records if r['md5'] in keep]
+    
+    # background updates of node progress, at most every UPDATE_SECS
+    def start_progress(self, node):
+        if self.reporter:
+            self.reporter.stop()
+        self.reporter = progress.ProgressReporter(self.shock, node, UPDATE_SECS)
+        return self.reporter
     
+    def progress_values(self, total, found, lookups=None, completed=None, saved=None):
+        values = {'queried': total, 'found': found}
+        if saved is not None:
+            values['saved_lookups'] = saved
+        if lookups:
+            values['in_flight'] = lookups.in_flight()
+            values['queued'] = lookups.queued
+        if completed:
+            values['completed'] = completed
+        return values
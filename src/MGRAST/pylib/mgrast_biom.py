@@ -0,0 +1,26 @@
+
+# BIOM 1.0 matrix helpers shared by Matrix and Profile
+# sparse data is a list of [ row, column, value ] for non-zero cells,
+# each costs three values, so it pays off below a third filled
+SPARSE_RATIO = 1.0 / 3
+MATRIX_TYPES = ['dense', 'sparse']
+
+# requested type wins, otherwise sparse if few enough cells are non-zero
+def matrix_type(nonzero, nrows, ncols, requested=None):
+    if requested in MATRIX_TYPES:
+        return requested
+    cells = nrows * ncols
+    if (cells > 0) and ((float(nonzero) / cells) <= SPARSE_RATIO):
+        return 'sparse'
+    return 'dense'
+
+def count_nonzero(data):
+    return sum(sum(1 for v in row if v) for row in data)
+
+def dense_to_sparse(data):
+    sparse = []
+    for r, row in enumerate(data):
+        for c, v in enumerate(row):
+            if v:
+                sparse.append([r, c, v])
+    return sparse
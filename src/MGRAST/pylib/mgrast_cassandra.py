@@ -1,15 +1,39 @@
 
 import os
+import sys
 import json
-import bisect
+import math
+import heapq
+import time
+import array
+import binascii
 import datetime
+import threading
+import numpy as np
+import hierarchy
+import bulk_load
 import cass_connection
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+import cassandra
 import cassandra.query as cql
 
-M5NR_VERSION = 1
+M5NR_VERSION  = 1
+LOOKUP_WINDOW = 8
+LOOKUP_MODES  = ['in', 'partition']
+# per process, every API process and build worker holds its own cache
+CACHE_BYTES   = int(os.environ.get('MGRAST_ANNOTATION_CACHE_MB', 64)) * 1024 * 1024
+EVALUE_MAX    = 50
+FETCH_SIZE    = 5000
+MERGE_FETCH   = 1000
+MERGE_WINDOW  = 64
+SCAN_RETRIES  = 4
+SCAN_BACKOFF  = 2
+READ_ERRORS   = (cassandra.ReadTimeout, cassandra.OperationTimedOut, cassandra.Unavailable)
+STAMP_SECS    = 60
+# helper tables of mgrast_abundance (job_counts, job_cutoffs, job_md5_cutoffs, job_lca_cutoffs)
+# are created by Schema/mgrast_abundance_helpers.cql
 
-def rmqLogger(channel, stype, statement, bulk=0):
+def rmqLogger(channel, stype, statement, bulk=0, stats=None):
     if not channel:
         return
     truncate = (statement[:98] + '..') if len(statement) > 100 else statement
@@ -19,6 +43,8 @@ def rmqLogger(channel, stype, statement, bulk=0):
         'statement': truncate,
         'bulk':      bulk
     }
+    if stats:
+        body['stats'] = stats
     if 'HOSTNAME' in os.environ:
         body['host'] = os.environ['HOSTNAME']
     try:
@@ -32,12 +58,127 @@ def rmqLogger(channel, stype, statement, bulk=0):
         # silently ignore broken logging
         pass
 
+class MergedFuture(object):
+    """Wraps the futures of concurrent single partition selects,
+    result() returns all rows in the order the statements were issued."""
+    def __init__(self, futures):
+        self.futures = futures
+    def result(self):
+        rows = []
+        for f in self.futures:
+            rows.extend(f.result())
+        return rows
+
+def recordSize(records):
+    # approximate memory footprint of a list of annotation rows
+    size = sys.getsizeof(records)
+    for r in records:
+        size += sys.getsizeof(r)
+        for k, v in r.items():
+            size += sys.getsizeof(k) + sys.getsizeof(v)
+            if isinstance(v, list):
+                size += sum(map(sys.getsizeof, v))
+    return size
+
+class AnnotationCache(object):
+    """Process-local LRU of M5NR annotation rows, keyed by
+    (m5nr version, table, source, md5) and bounded by approximate size in bytes.
+    M5NR keyspaces do not change once built, so entries only leave by eviction."""
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.lock = threading.Lock()
+        self.max_bytes = int(max_bytes)
+        self.entries = OrderedDict() # key : (records, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            # move to most recently used
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            self.hits += 1
+            return value[0]
+    def put(self, key, records):
+        size = recordSize(records)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (records, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, esize) = self.entries.popitem(last=False)
+                self.size -= esize
+                self.evictions += 1
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = int(max_bytes)
+            while self.size > self.max_bytes:
+                _, (_, esize) = self.entries.popitem(last=False)
+                self.size -= esize
+                self.evictions += 1
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.size = 0
+    def stats(self):
+        with self.lock:
+            return {
+                'entries'   : len(self.entries),
+                'bytes'     : self.size,
+                'max_bytes' : self.max_bytes,
+                'hits'      : self.hits,
+                'misses'    : self.misses,
+                'evictions' : self.evictions
+            }
+
+# shared by all handles in this process
+ANNOTATION_CACHE = AnnotationCache()
+
+class CachedFuture(object):
+    """Combines cached annotation rows with the lookup of the cache misses.
+    result() stores the fetched rows in the cache and returns copies of all rows
+    in the order of the requested md5s."""
+    def __init__(self, cache, prefix, md5s, cached, future):
+        self.cache = cache
+        self.prefix = prefix
+        self.md5s = md5s
+        self.cached = cached
+        self.future = future
+    def result(self):
+        if self.future:
+            fetched = defaultdict(list)
+            for r in self.future.result():
+                fetched[r['md5']].append(r)
+            for md5 in self.md5s:
+                if md5 not in self.cached:
+                    self.cached[md5] = fetched[md5]
+                    self.cache.put(self.prefix+(md5,), fetched[md5])
+            self.future = None
+        rows = []
+        for md5 in self.md5s:
+            for r in self.cached[md5]:
+                rows.append(dict(r))
+        return rows
+
+# version : (checked, (stamp, loading)) of hierarchy tables
+HIERARCHY_STAMPS = {}
+
 class M5nrHandle(object):
-    def __init__(self, hosts, version=M5NR_VERSION):
+    def __init__(self, hosts, version=M5NR_VERSION, lookup='in', cache=True):
         keyspace = "m5nr_v"+str(version)
+        self.version = int(version)
         self.session = cass_connection.create(hosts).connect(keyspace)
         self.session.default_timeout = 300
         self.session.row_factory = cql.dict_factory
+        self.prepared = cass_connection.PreparedCache(self.session)
+        self.cache = ANNOTATION_CACHE if cache else None
+        self.set_lookup(lookup)
         self.channel = None
         try:
             self.channel = cass_connection.rmqConnection().channel()
@@ -45,17 +186,19 @@ class M5nrHandle(object):
             pass
     def close(self):
         cass_connection.destroy()
+    ## size limit of the process annotation cache shared by all handles, 0 disables caching
+    def set_cache_size(self, mbytes):
+        ANNOTATION_CACHE.set_max_bytes(int(mbytes) * 1024 * 1024)
+    ## 'in': one multi-partition IN query per md5 list
+    ## 'partition': concurrent prepared single partition selects, routed token aware
+    def set_lookup(self, mode):
+        if mode not in LOOKUP_MODES:
+            raise Exception("invalid lookup mode '%s', use one of: %s"%(mode, ", ".join(LOOKUP_MODES)))
+        self.lookup = mode
     ### retrieve M5NR records
     def get_records_by_md5(self, md5s, source=None, index=False, iterator=False):
         found = []
-        table = "midx_annotation" if index else "md5_annotation"
-        md5_str = ",".join(map(lambda x: "'"+x+"'", md5s))
-        if source:
-            query = "SELECT * FROM %s WHERE md5 IN (%s) AND source='%s'"%(table, md5_str, source)
-        else:
-            query = "SELECT * FROM %s WHERE md5 IN (%s)"%(table, md5_str)
-        rmqLogger(self.channel, 'select', query)
-        rows = self.session.execute(query)
+        rows = self.get_records_by_md5_async(md5s, source=source, index=index).result()
         if iterator:
             return rows
         else:
@@ -63,11 +206,58 @@ class M5nrHandle(object):
                 r['is_protein'] = 1 if r['is_protein'] else 0
                 found.append(r)
             return found
+    ## cache hit / miss / eviction counters
+    def cache_stats(self):
+        return self.cache.stats() if self.cache else None
+    ## prepared statement reuse counters
+    def prepared_stats(self):
+        return self.prepared.stats()
+    ## non-blocking version of get_records_by_md5, returns future-like object
+    ## only cache misses are sent to cassandra
+    def get_records_by_md5_async(self, md5s, source=None, index=False):
+        if not self.cache:
+            return self._query_records_async(md5s, source, index)
+        table  = "midx_annotation" if index else "md5_annotation"
+        prefix = (self.version, table, source)
+        md5s   = list(md5s)
+        cached = {}
+        missing = []
+        for md5 in md5s:
+            records = self.cache.get(prefix+(md5,))
+            if records is None:
+                missing.append(md5)
+            else:
+                cached[md5] = records
+        future = self._query_records_async(missing, source, index) if len(missing) > 0 else None
+        return CachedFuture(self.cache, prefix, md5s, cached, future)
+    def _query_records_async(self, md5s, source=None, index=False):
+        if self.lookup == 'partition':
+            return self._partition_records_async(md5s, source, index)
+        table = "midx_annotation" if index else "md5_annotation"
+        query = "SELECT * FROM %s WHERE md5 IN ?"%(table)
+        where = [list(md5s)]
+        if source:
+            query += " AND source = ?"
+            where.append(source)
+        rmqLogger(self.channel, 'select', query, len(where[0]))
+        return self.session.execute_async(self.prepared.get(query), where)
+    def _partition_records_async(self, md5s, source=None, index=False):
+        table = "midx_annotation" if index else "md5_annotation"
+        query = "SELECT * FROM %s WHERE md5 = ?"%(table)
+        if source:
+            query += " AND source = ?"
+        md5s = list(md5s)
+        rmqLogger(self.channel, 'select', query, len(md5s))
+        prep = self.prepared.get(query)
+        futures = []
+        for md5 in md5s:
+            where = [md5, source] if source else [md5]
+            futures.append(self.session.execute_async(prep, where))
+        return MergedFuture(futures)
     def get_functions_by_id(self, ids, compress, iterator=False):
-        id_str = ",".join(map(str, ids))
-        query = "SELECT * FROM functions WHERE id IN (%s)"%(id_str)
-        rmqLogger(self.channel, 'select', query)
-        rows = self.session.execute(query)
+        query = "SELECT * FROM functions WHERE id IN ?"
+        rmqLogger(self.channel, 'select', query, len(ids))
+        rows = self.session.execute(self.prepared.get(query), [list(map(int, ids))])
         if iterator:
             return rows
         else:
@@ -80,56 +270,39 @@ class M5nrHandle(object):
                 for r in rows:
                     found.append( {'function_id': r['id'], 'function': r['name']} )
             return found
-    ### retrieve full hierarchies
-    def get_taxa_hierarchy(self):
-        found = {}
-        query = "SELECT * FROM organisms_ncbi"
+    ### retrieve full hierarchies, served from local snapshot
+    def get_hierarchy(self):
+        stamp, loading = self.hierarchy_stamp()
+        return hierarchy.get(self.version, self._scan, stamp, loading)
+    ## (stamp, loading) of hierarchy tables, checked at most every STAMP_SECS per process
+    def hierarchy_stamp(self):
+        checked = HIERARCHY_STAMPS.get(self.version)
+        if checked and ((time.time() - checked[0]) < STAMP_SECS):
+            return checked[1]
+        query = "SELECT stamp, loading FROM hierarchy_stamp WHERE version = ?"
         rmqLogger(self.channel, 'select', query)
-        rows  = self.session.execute(query)
-        for r in rows:
-            found[r['name']] = [r['tax_domain'], r['tax_phylum'], r['tax_class'], r['tax_order'], r['tax_family'], r['tax_genus'], r['tax_species']]
+        try:
+            rows = self.session.execute(self.prepared.get(query), [self.version])
+        except cassandra.InvalidRequest:
+            # keyspace created without stamp table
+            rows = None
+        found = (None, False)
+        if rows and (len(rows.current_rows) > 0):
+            found = (rows[0]['stamp'], True if rows[0]['loading'] else False)
+        HIERARCHY_STAMPS[self.version] = (time.time(), found)
         return found
-    def get_ontology_hierarchy(self, source=None):
-        found = {}
-        query = "SELECT * FROM ontologies"
-        if source:
-            query += " WHERE source = ?"
-            prep = self.session.prepare(query)
-            for r in self.session.execute(prep, [source]):
-                found[r['name']] = [r['level1'], r['level2'], r['level3'], r['level4']]
-        else:
-            for r in self.session.execute(query):
-                if r['source'] not in found:
-                    found[r['source']] = {}
-                found[r['source']][r['name']] = [r['level1'], r['level2'], r['level3'], r['level4']]
+    def _scan(self, query):
         rmqLogger(self.channel, 'select', query)
-        return found
+        return self.session.execute(query)
+    def get_taxa_hierarchy(self):
+        return self.get_hierarchy().taxa_hierarchy()
+    def get_ontology_hierarchy(self, source=None):
+        return self.get_hierarchy().ontology_hierarchy(source)
     ### retrieve hierarchy mapping: leaf -> level
     def get_org_taxa_map(self, taxa):
-        found = {}
-        tname = "tax_"+taxa.lower()
-        query = "SELECT * FROM "+tname
-        rmqLogger(self.channel, 'select', query)
-        rows  = self.session.execute(query)
-        for r in rows:
-            found[r['name']] = r[tname]
-        return found
+        return self.get_hierarchy().org_taxa_map(taxa)
     def get_ontology_map(self, level, source=None):
-        found = {}
-        level = level.lower()
-        query = "SELECT * FROM ont_%s"%level
-        if source:
-            query += " WHERE source = ?"
-            prep = self.session.prepare(query)
-            for r in self.session.execute(prep, [source]):
-                found[r['name']] = r[level]
-        else:
-            for r in self.session.execute(query):
-                if r['source'] not in found:
-                    found[r['source']] = {}
-                found[r['source']][r['name']] = r[level]
-        rmqLogger(self.channel, 'select', query)
-        return found
+        return self.get_hierarchy().ontology_map(level, source)
     ### retrieve hierarchy: leaf list for a level
     def get_organism_by_taxa(self, taxa, match=None):
         # if match is given, return subset that contains match, else all
@@ -150,8 +323,7 @@ class M5nrHandle(object):
         level = level.lower()
         query = "SELECT * FROM ont_%s WHERE source = ?"%level
         rmqLogger(self.channel, 'select', query)
-        prep = self.session.prepare(query)
-        rows = self.session.execute(prep, [source])
+        rows = self.session.execute(self.prepared.get(query), [source])
         for r in rows:
             if match and (match.lower() in r[level].lower()):
                 found.add(r['name'])
@@ -159,6 +331,109 @@ class M5nrHandle(object):
                 found.add(r['name'])
         return list(found)
 
+class LookupPipeline(object):
+    """Keeps up to `window` annotation lookups in flight while the caller
+    continues reading job rows. Each submit hands back the lookups that had to
+    complete to stay within the window, as (data, records) in submit order."""
+    def __init__(self, m5nr, source=None, index=False, window=LOOKUP_WINDOW):
+        self.m5nr = m5nr
+        self.source = source
+        self.index = index
+        self.window = max(1, int(window))
+        self.pending = deque() # (future, data, md5 count)
+        self.queued = 0        # md5s submitted and not yet returned
+    def in_flight(self):
+        return len(self.pending)
+    def submit(self, md5s, data=None):
+        md5s = list(md5s)
+        if len(md5s) == 0:
+            return [(data, [])]
+        future = self.m5nr.get_records_by_md5_async(md5s, source=self.source, index=self.index)
+        self.pending.append((future, data, len(md5s)))
+        self.queued += len(md5s)
+        done = []
+        while len(self.pending) > self.window:
+            done.append(self._next())
+        return done
+    def drain(self):
+        done = []
+        while len(self.pending) > 0:
+            done.append(self._next())
+        return done
+    def _next(self):
+        future, data, count = self.pending.popleft()
+        self.queued -= count
+        return data, future.result()
+
+# job data tables, columns after version and job are in abundance file order
+JOB_INSERTS = {
+    'md5' : "INSERT INTO job_md5s (version, job, md5, abundance, exp_avg, ident_avg, len_avg, seek, length) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+    'lca' : "INSERT INTO job_lcas (version, job, lca, abundance, exp_avg, ident_avg, len_avg, md5s, level) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+}
+# same rows bucketed by cutoffs, ebucket is the integer evalue exponent, ibucket the integer identity
+CUTOFF_INSERTS = {
+    'md5' : "INSERT INTO job_md5_cutoffs (version, job, ebucket, ibucket, md5, abundance, exp_avg, ident_avg, len_avg, seek, length) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+    'lca' : "INSERT INTO job_lca_cutoffs (version, job, ebucket, ibucket, lca, abundance, exp_avg, ident_avg, len_avg, md5s, level) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+}
+
+def jobPartition(params):
+    # (version, job) of a job table insert
+    return (params[0], params[1])
+
+def cutoffPartition(params):
+    # (version, job, ebucket) of a cutoff table insert
+    return (params[0], params[1], params[2])
+
+## row passes evalue cutoff e (exp_avg <= -e) if ebucket >= e,
+## and identity cutoff i (ident_avg >= i) if ibucket >= i, for integer cutoffs
+def evalueBucket(exp_avg):
+    return min(EVALUE_MAX, max(0, int(math.floor(-exp_avg))))
+
+def identityBucket(ident_avg):
+    return min(100, max(0, int(math.floor(ident_avg))))
+
+## cutoff bucket rows are fields + [ exp_avg, ident_avg, len_avg, key ],
+## trim is (number of fields, evalue, identity, length)
+def keepRow(r, trim):
+    size, evalue, identity, alength = trim
+    return ((r[size] <= -evalue) or not evalue) and (r[size+1] >= identity) and (r[size+2] >= alength)
+
+def keepRows(rows, trim):
+    return [r for r in rows if keepRow(r, trim)]
+
+def trimRows(rows, trim):
+    return [r[:trim[0]] for r in keepRows(rows, trim)]
+
+## parts [ lo, hi ) ranges of lowercase hex md5s by two character prefix, open ended at both ends
+def md5Ranges(parts):
+    parts = max(1, min(256, int(parts)))
+    bounds = [None] + ['%02x'%((i * 256) // parts) for i in range(1, parts)] + [None]
+    return [(bounds[i], bounds[i+1]) for i in range(parts)]
+
+## coalesce (seek, length) ranges, sorted once then merged where ranges touch or overlap,
+## returns int64 arrays of start and length
+def coalesceRanges(seeks, lengths):
+    seeks = np.asarray(seeks, dtype=np.int64)
+    ends = seeks + np.asarray(lengths, dtype=np.int64)
+    if len(seeks) == 0:
+        return seeks, ends
+    order = np.argsort(seeks, kind='mergesort')
+    seeks, ends = seeks[order], ends[order]
+    # a range starts a new block if it begins after every earlier range ended
+    first = np.ones(len(seeks), dtype=bool)
+    first[1:] = seeks[1:] > np.maximum.accumulate(ends)[:-1]
+    starts = np.nonzero(first)[0]
+    return seeks[starts], np.maximum.reduceat(ends, starts) - seeks[starts]
+
+def iterRanges(seeks, lengths, chunk=FETCH_SIZE):
+    for i in range(0, len(seeks), chunk):
+        for r in zip(seeks[i:i+chunk].tolist(), lengths[i:i+chunk].tolist()):
+            yield r
+
+def cutoffParams(params):
+    # job table params -> cutoff table params
+    return [p[:2] + (evalueBucket(p[4]), identityBucket(p[5])) + p[2:] for p in params]
+
 class JobHandle(object):
     def __init__(self, hosts, version=M5NR_VERSION):
         keyspace = "mgrast_abundance"
@@ -166,6 +441,9 @@ class JobHandle(object):
         self.session = cass_connection.create(hosts).connect(keyspace)
         self.session.default_timeout = 300
         self.session.row_factory = cql.tuple_factory
+        self.prepared = cass_connection.PreparedCache(self.session)
+        # read cutoff filtered rows from bucket tables when populated
+        self.cutoff_buckets = True
         self.channel = None
         try:
             self.channel = cass_connection.rmqConnection().channel()
@@ -173,34 +451,45 @@ class JobHandle(object):
             pass
     def close(self):
         cass_connection.destroy()
+    ## prepared statement reuse counters
+    def prepared_stats(self):
+        return self.prepared.stats()
     ## get iterator for md5 records of a job
     def get_job_records(self, job, fields, swap=None, evalue=None, identity=None, alength=None):
-        job = int(job)
-        if swap:
-            identity, alength = alength, identity
-        query = "SELECT "+",".join(fields)+" FROM job_md5s WHERE version = ? AND job = ?"
-        where = [self.version, job]
-        if evalue:
-            query += " AND exp_avg <= ?"
-            where.append(int(evalue) * -1)
-        if identity:
-            query += " AND ident_avg >= ?"
-            where.append(int(identity))
-        if alength:
-            query += " AND len_avg >= ?"
-            where.append(int(alength))
-        if evalue or identity or alength:
-            query += " ALLOW FILTERING"
-        rmqLogger(self.channel, 'select', query)
-        prep = self.session.prepare(query)
-        return self.session.execute(prep, where)
+        return self._get_records(job, 'md5', fields, swap, evalue, identity, alength)
     ## get iterator for lca records of a job
     def get_lca_records(self, job, fields, swap=None, evalue=None, identity=None, alength=None):
+        return self._get_records(job, 'lca', fields, swap, evalue, identity, alength)
+    def _get_records(self, job, val, fields, swap=None, evalue=None, identity=None, alength=None):
+        segment = self.record_segments(job, val, fields, 1, swap, evalue, identity, alength)[0]
+        queries, trim = segment
+        if (len(queries) == 1) and (not trim):
+            query, where = queries[0]
+            return self.session.execute(self.prepared.get(query), where)
+        return self.scan_segment(segment)
+    ## split the scan of md5 or lca records into parts ordered segments, scanning them
+    ## in order returns the rows in the order of the single scan. a segment is a list of
+    ## (query, bind values) and a trim spec for trimRows, None if rows need no filtering.
+    ## md5 scans are split by md5 prefix ranges, cutoff bucket scans are one segment
+    ## as their rows are sorted into key order
+    def record_segments(self, job, val, fields, parts=1, swap=None, evalue=None, identity=None, alength=None):
         job = int(job)
+        parts = max(1, int(parts))
         if swap:
             identity, alength = alength, identity
-        query = "SELECT "+",".join(fields)+" FROM job_lcas WHERE version = ? AND job = ?"
+        if (evalue or identity or alength) and self.has_cutoffs(job, val):
+            return [self._bucket_queries(job, val, fields, evalue, identity, alength)]
+        ranges = md5Ranges(parts) if val == 'md5' else [(None, None)]
+        return [([self._record_query(job, val, fields, evalue, identity, alength, lo, hi)], None) for lo, hi in ranges]
+    def _record_query(self, job, val, fields, evalue=None, identity=None, alength=None, lo=None, hi=None):
+        query = "SELECT "+",".join(fields)+" FROM job_%ss WHERE version = ? AND job = ?"%(val)
         where = [self.version, job]
+        if lo:
+            query += " AND md5 >= ?"
+            where.append(lo)
+        if hi:
+            query += " AND md5 < ?"
+            where.append(hi)
         if evalue:
             query += " AND exp_avg <= ?"
             where.append(int(evalue) * -1)
@@ -213,63 +502,195 @@ class JobHandle(object):
         if evalue or identity or alength:
             query += " ALLOW FILTERING"
         rmqLogger(self.channel, 'select', query)
-        prep = self.session.prepare(query)
-        return self.session.execute(prep, where)
+        return (query, where)
+    ## one clustering slice per qualifying (evalue, identity) bucket, each in key order.
+    ## length, and evalues beyond the last bucket, are filtered client side
+    def _bucket_queries(self, job, val, fields, evalue=None, identity=None, alength=None):
+        evalue = int(evalue) if evalue else 0
+        identity = int(identity) if identity else 0
+        alength = int(alength) if alength else 0
+        query = "SELECT "+",".join(list(fields)+['exp_avg', 'ident_avg', 'len_avg', val])+" FROM job_%s_cutoffs WHERE version = ? AND job = ? AND ebucket = ? AND ibucket = ?"%(val)
+        rmqLogger(self.channel, 'select', query)
+        queries = []
+        for e in range(min(evalue, EVALUE_MAX), EVALUE_MAX+1):
+            for i in range(min(identity, 100), 101):
+                queries.append((query, [self.version, job, e, i]))
+        return queries, (len(fields), evalue, identity, alength)
+    ## rows of one segment, its queries are sent at once and rows come in query order.
+    ## bucket slices are read page by page and merged into the key order of the job table
+    def scan_segment(self, segment):
+        queries, trim = segment
+        if not trim:
+            futures = [self.session.execute_async(self.prepared.get(query), where) for query, where in queries]
+            for f in futures:
+                for r in f.result():
+                    yield r
+            return
+        # first page of every slice, at most MERGE_WINDOW requested at once
+        results = []
+        pending = deque()
+        for query, where in queries:
+            stmt = cql.BoundStatement(self.prepared.get(query), fetch_size=MERGE_FETCH).bind(where)
+            pending.append(self.session.execute_async(stmt))
+            if len(pending) >= MERGE_WINDOW:
+                results.append(pending.popleft().result())
+        while len(pending) > 0:
+            results.append(pending.popleft().result())
+        size = trim[0]
+        def keyed(n, rows):
+            # slice number breaks ties, rows are never compared
+            for r in rows:
+                if keepRow(r, trim):
+                    yield (r[size+3], n, r)
+        for _, _, r in heapq.merge(*[keyed(n, rows) for n, rows in enumerate(results)]):
+            yield r[:size]
+    ## paged scan of md5 or lca records of a job, yields (rows, state) per page of at most fetch_size rows.
+    ## state is a json-able dict, pass it as resume to continue after that page, it is None after the last page.
+    ## pages of cutoff bucket scans are in (ebucket, ibucket, key) order, not sorted as get_job_records
+    def scan_job_records(self, job, fields, val='md5', fetch_size=FETCH_SIZE, resume=None, swap=None, evalue=None, identity=None, alength=None):
+        queries, trim = self.record_segments(job, val, fields, 1, swap, evalue, identity, alength)[0]
+        start, paging = 0, None
+        if resume:
+            start = resume['query']
+            if resume['paging']:
+                paging = binascii.unhexlify(resume['paging'])
+        for i in range(start, len(queries)):
+            query, where = queries[i]
+            while True:
+                stmt = cql.BoundStatement(self.prepared.get(query), fetch_size=fetch_size).bind(where)
+                rs = self.session.execute(stmt, paging_state=paging)
+                paging = rs.paging_state
+                rows = rs.current_rows
+                if trim:
+                    rows = trimRows(rows, trim)
+                if paging:
+                    state = {'query': i, 'paging': binascii.hexlify(paging).decode('ascii')}
+                elif (i + 1) < len(queries):
+                    state = {'query': i + 1, 'paging': None}
+                else:
+                    state = None
+                yield rows, state
+                if not paging:
+                    break
+    ## records of scan_job_records, a page that fails to read is read again from the state
+    ## of the page before, with backoff, up to retries times in a row
+    def resumable_records(self, job, fields, val='md5', fetch_size=FETCH_SIZE, resume=None, retries=SCAN_RETRIES, swap=None, evalue=None, identity=None, alength=None):
+        state = resume
+        failed = 0
+        while True:
+            try:
+                for rows, state in self.scan_job_records(job, fields, val, fetch_size, state, swap, evalue, identity, alength):
+                    failed = 0
+                    for r in rows:
+                        yield r
+                return
+            except READ_ERRORS:
+                failed += 1
+                if failed > retries:
+                    raise
+                time.sleep(min(bulk_load.MAX_SLEEP, SCAN_BACKOFF * (2 ** (failed - 1))))
+    ## are all rows of job type in cutoff tables
+    def has_cutoffs(self, job, val):
+        if not self.cutoff_buckets:
+            return False
+        query = "SELECT %ss FROM job_cutoffs WHERE version = ? AND job = ?"%(val)
+        rmqLogger(self.channel, 'select', query)
+        rows = self.session.execute(self.prepared.get(query), [self.version, int(job)])
+        return (len(rows.current_rows) > 0) and bool(rows[0][0])
+    ## start of a (re)load, old bucket rows are removed as their bucket may change.
+    ## bucketed is False when the job rows are removed, bucket tables are not read for it
+    def reset_cutoffs(self, job, val, bucketed=True):
+        batch = cql.BatchStatement(consistency_level=cql.ConsistencyLevel.QUORUM)
+        cmd = "DELETE FROM job_%s_cutoffs WHERE version = ? AND job = ? AND ebucket = ?"%(val)
+        rmqLogger(self.channel, 'delete', cmd)
+        for e in range(EVALUE_MAX+1):
+            batch.add(self.prepared.get(cmd), (self.version, job, e))
+        # rows inserted from now on are bucketed
+        cmd = "UPDATE job_cutoffs SET %ss = ? WHERE version = ? AND job = ?"%(val)
+        rmqLogger(self.channel, 'update', cmd)
+        batch.add(self.prepared.get(cmd), (bucketed, self.version, job))
+        self.session.execute(batch)
     ## get index for one md5
     def get_md5_record(self, job, md5):
         job = int(job)
         query = "SELECT seek, length FROM job_md5s WHERE version = ? AND job = ? AND md5 = ?"
         rmqLogger(self.channel, 'select', query)
-        prep = self.session.prepare(query)
-        rows = self.session.execute(prep, [self.version, job, md5])
+        rows = self.session.execute(self.prepared.get(query), [self.version, job, md5])
         if (len(rows.current_rows) > 0) and (rows[0][1] > 0):
             return [ rows[0][0], rows[0][1] ]
         else:
             return None
-    ## get indexes for given md5 list or cutoff values
-    def get_md5_records(self, job, swap=None, md5s=None, evalue=None, identity=None, alength=None):
+    ## get indexes for given md5 list or cutoff values, contiguous ranges are merged
+    ## form: 'list' of (seek, length), 'array' of (seeks, lengths) int64 arrays,
+    ## or 'iterator' of (seek, length) in seek order
+    def get_md5_records(self, job, swap=None, md5s=None, evalue=None, identity=None, alength=None, form='list'):
         job = int(job)
         if swap:
             identity, alength = alength, identity
-        found = []
-        query = "SELECT seek, length FROM job_md5s WHERE version = %d AND job = %d"%(self.version, job)
         if md5s and (len(md5s) > 0):
-            query += " AND md5 IN (" + ",".join(map(lambda x: "'"+x+"'", md5s)) + ")"
-        elif evalue or identity or alength:
-            if evalue:
-                query += " AND exp_avg <= %d"%(int(evalue) * -1)
-            if identity:
-                query += " AND ident_avg >= %d"%(int(identity))
-            if alength:
-                query += " AND len_avg >= %d"%(int(alength))
-            query += " ALLOW FILTERING"
-        rmqLogger(self.channel, 'select', query)
-        rows = self.session.execute(query)
+            query = "SELECT seek, length FROM job_md5s WHERE version = ? AND job = ? AND md5 IN ?"
+            rmqLogger(self.channel, 'select', query)
+            rows = self.session.execute(self.prepared.get(query), [self.version, job, list(md5s)])
+        else:
+            rows = self._get_records(job, 'md5', ['seek', 'length'], None, evalue, identity, alength)
+        seeks = array.array('l')
+        lengths = array.array('l')
         for r in rows:
-            if r[1] == 0 or r[0] is None:  # skip row if zero length, or row is corrupt
+            if (not r[1]) or (r[0] is None):  # skip row if zero length, or row is corrupt
                 continue
-            pos = bisect.bisect(found, (r[0], None))
-            if (pos > 0) and ((found[pos-1][0] + found[pos-1][1]) == r[0]):
-                found[pos-1] = (found[pos-1][0], found[pos-1][1] + r[1])
-            else:
-                bisect.insort(found, (r[0], r[1]))
-        return found
-    ## row counts based on info table counter
+            seeks.append(r[0])
+            lengths.append(r[1])
+        seeks, lengths = coalesceRanges(seeks, lengths)
+        if form == 'array':
+            return seeks, lengths
+        elif form == 'iterator':
+            return iterRanges(seeks, lengths)
+        return list(zip(seeks.tolist(), lengths.tolist()))
+    ## row counts based on loading counter, info table for jobs loaded without counter
     def get_info_count(self, job, val):
         job = int(job)
-        query = "SELECT %ss FROM job_info WHERE version = %d AND job = %d"%(val, self.version, job)
+        count = self.get_counter(job, val)
+        if count is not None:
+            return count
+        query = "SELECT %ss FROM job_info WHERE version = ? AND job = ?"%(val)
         rmqLogger(self.channel, 'select', query)
-        rows = self.session.execute(query)
+        rows = self.session.execute(self.prepared.get(query), [self.version, job])
         if len(rows.current_rows) > 0:
             return rows[0][0]
         else:
             return 0
+    ## loading counters, rows of a job may be inserted concurrently
+    def get_counter(self, job, val):
+        query = "SELECT %ss FROM job_counts WHERE version = ? AND job = ?"%(val)
+        rmqLogger(self.channel, 'select', query)
+        select = cql.BoundStatement(
+            self.prepared.get(query),
+            consistency_level=cql.ConsistencyLevel.QUORUM
+        ).bind([self.version, int(job)])
+        rows = self.session.execute(select)
+        if (len(rows.current_rows) > 0) and (rows[0][0] is not None):
+            return rows[0][0]
+        else:
+            return None
+    def add_counter(self, job, val, delta):
+        cmd = "UPDATE job_counts SET {0}s = {0}s + ? WHERE version = ? AND job = ?".format(val)
+        rmqLogger(self.channel, 'update', cmd)
+        update = cql.BoundStatement(
+            self.prepared.get(cmd),
+            consistency_level=cql.ConsistencyLevel.QUORUM
+        ).bind([int(delta), self.version, int(job)])
+        self.session.execute(update)
+    ## counters can not be set, move to value by difference
+    def reset_counter(self, job, val, value=0):
+        current = self.get_counter(job, val) or 0
+        if current != int(value):
+            self.add_counter(job, val, int(value) - current)
     ## row counts based on data tables
     def get_data_count(self, job, val):
         job = int(job)
-        query = "SELECT COUNT(*) FROM job_%ss WHERE version = %d AND job = %d"%(val, self.version, job)
+        query = "SELECT COUNT(*) FROM job_%ss WHERE version = ? AND job = ?"%(val)
         rmqLogger(self.channel, 'select', query)
-        rows = self.session.execute(query)
+        rows = self.session.execute(self.prepared.get(query), [self.version, job])
         if len(rows.current_rows) > 0:
             return rows[0][0]
         else:
@@ -277,9 +698,9 @@ class JobHandle(object):
     ## does job exist
     def has_job(self, job):
         job = int(job)
-        query = "SELECT * FROM job_info WHERE version = %d AND job = %d"%(self.version, job)
+        query = "SELECT * FROM job_info WHERE version = ? AND job = ?"
         rmqLogger(self.channel, 'select', query)
-        rows = self.session.execute(query)
+        rows = self.session.execute(self.prepared.get(query), [self.version, job])
         if len(rows.current_rows) > 0:
             return 1
         else:
@@ -287,18 +708,18 @@ class JobHandle(object):
     ## job status
     def last_updated(self, job):
         job = int(job)
-        query = "SELECT updated_on FROM job_info WHERE version = %d AND job = %d"%(self.version, job)
+        query = "SELECT updated_on FROM job_info WHERE version = ? AND job = ?"
         rmqLogger(self.channel, 'select', query)
-        rows = self.session.execute(query)
+        rows = self.session.execute(self.prepared.get(query), [self.version, job])
         if len(rows.current_rows) > 0:
             return rows[0][0]
         else:
             return None
     def is_loaded(self, job):
         job = int(job)
-        query = "SELECT loaded FROM job_info WHERE version = %d AND job = %d"%(self.version, job)
+        query = "SELECT loaded FROM job_info WHERE version = ? AND job = ?"
         rmqLogger(self.channel, 'select', query)
-        rows = self.session.execute(query)
+        rows = self.session.execute(self.prepared.get(query), [self.version, job])
         if (len(rows.current_rows) > 0) and rows[0][0]:
             return 1
         else:
@@ -306,24 +727,40 @@ class JobHandle(object):
     ## get all info
     def get_job_info(self, job):
         job = int(job)
-        query = "SELECT md5s, lcas, loaded, updated_on FROM job_info WHERE version = %d AND job = %d"%(self.version, job)
+        query = "SELECT md5s, lcas, loaded, updated_on FROM job_info WHERE version = ? AND job = ?"
         rmqLogger(self.channel, 'select', query)
-        rows = self.session.execute(query)
+        rows = self.session.execute(self.prepared.get(query), [self.version, job])
         if len(rows.current_rows) > 0:
             load = 'true' if rows[0][2] else 'false'
-            return dict(md5s=rows[0][0], lcas=rows[0][1], loaded=load, updated_on=rows[0][3])
+            info = dict(md5s=rows[0][0], lcas=rows[0][1], loaded=load, updated_on=rows[0][3])
+            # counts are moved into job_info when loading ends
+            if not rows[0][2]:
+                for val in ['md5', 'lca']:
+                    count = self.get_counter(job, val)
+                    if count is not None:
+                        info[val+'s'] = count
+            return info
         else:
             return None
     ## update job_info table
+    ## when done, loading counters are committed to job_info
     def set_loaded(self, job, loaded):
         job = int(job)
         value = True if loaded else False
-        cmd = "UPDATE job_info SET loaded = ?, updated_on = ? WHERE version = ? AND job = ?"
+        sets  = ["loaded = ?", "updated_on = ?"]
+        where = [value, datetime.datetime.now()]
+        if value:
+            for val in ['md5', 'lca']:
+                count = self.get_counter(job, val)
+                if count is not None:
+                    sets.append(val+"s = ?")
+                    where.append(count)
+        cmd = "UPDATE job_info SET %s WHERE version = ? AND job = ?"%(", ".join(sets))
         rmqLogger(self.channel, 'update', cmd)
         update = cql.BoundStatement(
-            self.session.prepare(cmd),
+            self.prepared.get(cmd),
             consistency_level=cql.ConsistencyLevel.QUORUM
-        ).bind([value, datetime.datetime.now(), self.version, job])
+        ).bind(where + [self.version, job])
         self.session.execute(update)
     def update_info_md5s(self, job, md5s, loaded):
         job = int(job)
@@ -331,80 +768,89 @@ class JobHandle(object):
         cmd = "UPDATE job_info SET md5s = ?, loaded = ?, updated_on = ? WHERE version = ? AND job = ?"
         rmqLogger(self.channel, 'update', cmd)
         update = cql.BoundStatement(
-            self.session.prepare(cmd),
+            self.prepared.get(cmd),
             consistency_level=cql.ConsistencyLevel.QUORUM
         ).bind([int(md5s), value, datetime.datetime.now(), self.version, job])
         self.session.execute(update)
+        self.reset_counter(job, 'md5', md5s)
+        if int(md5s) == 0:
+            self.reset_cutoffs(job, 'md5')
     def update_info_lcas(self, job, lcas, loaded):
         job = int(job)
         value = True if loaded else False
         cmd = "UPDATE job_info SET lcas = ?, loaded = ?, updated_on = ? WHERE version = ? AND job = ?"
         rmqLogger(self.channel, 'update', cmd)
         update = cql.BoundStatement(
-            self.session.prepare(cmd),
+            self.prepared.get(cmd),
             consistency_level=cql.ConsistencyLevel.QUORUM
         ).bind([int(lcas), value, datetime.datetime.now(), self.version, job])
         self.session.execute(update)
+        self.reset_counter(job, 'lca', lcas)
+        if int(lcas) == 0:
+            self.reset_cutoffs(job, 'lca')
     def insert_job_info(self, job):
         job = int(job)
         cmd = "INSERT INTO job_info (version, job, md5s, lcas, updated_on, loaded) VALUES (?, ?, ?, ?, ?, ?)"
         rmqLogger(self.channel, 'insert', cmd)
         insert = cql.BoundStatement(
-            self.session.prepare(cmd),
+            self.prepared.get(cmd),
             consistency_level=cql.ConsistencyLevel.QUORUM
         ).bind([self.version, job, 0, 0, datetime.datetime.now(), False])
         self.session.execute(insert)
+        for val in ['md5', 'lca']:
+            self.reset_counter(job, val)
+            self.reset_cutoffs(job, val)
     ## add rows to job data tables, return current total loaded
+    ## rows are written as concurrent unlogged batches and counted server side,
+    ## so several loaders may insert into one job
     def insert_job_md5s(self, job, rows):
-        job = int(job)
-        cmd = "INSERT INTO job_md5s (version, job, md5, abundance, exp_avg, ident_avg, len_avg, seek, length) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
-        rmqLogger(self.channel, 'insert', cmd, len(rows))
-        insert = self.session.prepare(cmd)
-        batch  = cql.BatchStatement(consistency_level=cql.ConsistencyLevel.QUORUM)
-        for (md5, abundance, exp_avg, ident_avg, len_avg, seek, length) in rows:
-            if not seek:
-                seek = 0
-            if not length:
-                length = 0
-            batch.add(insert, (self.version, job, md5, int(abundance), float(exp_avg), float(ident_avg), float(len_avg), int(seek), int(length)))
-        # update job_info
-        loaded = self.get_info_count(job, 'md5') + len(rows)
-        cmd = "UPDATE job_info SET md5s = ?, loaded = ?, updated_on = ? WHERE version = ? AND job = ?"
-        rmqLogger(self.channel, 'update', cmd)
-        update = self.session.prepare(cmd)
-        batch.add(update, (loaded, False, datetime.datetime.now(), self.version, job))
-        # execute atomic batch
-        self.session.execute(batch)
-        return loaded
+        return self._insert_job_rows(int(job), 'md5', rows)
     def insert_job_lcas(self, job, rows):
-        job = int(job)
-        cmd = "INSERT INTO job_lcas (version, job, lca, abundance, exp_avg, ident_avg, len_avg, md5s, level) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        return self._insert_job_rows(int(job), 'lca', rows)
+    ## bound params for JOB_INSERTS[val] from abundance rows
+    def job_params(self, job, val, rows):
+        params = []
+        if val == 'md5':
+            for (md5, abundance, exp_avg, ident_avg, len_avg, seek, length) in rows:
+                if not seek:
+                    seek = 0
+                if not length:
+                    length = 0
+                params.append((self.version, job, md5, int(abundance), float(exp_avg), float(ident_avg), float(len_avg), int(seek), int(length)))
+        else:
+            for (lca, abundance, exp_avg, ident_avg, len_avg, md5s, level) in rows:
+                params.append((self.version, job, lca, int(abundance), float(exp_avg), float(ident_avg), float(len_avg), int(md5s), int(level)))
+        return params
+    ## write job_params rows to job table and its cutoff table
+    def write_job_rows(self, writer, val, params):
+        writer.write(self.prepared.get(JOB_INSERTS[val]), params, jobPartition)
+        writer.write(self.prepared.get(CUTOFF_INSERTS[val]), cutoffParams(params), cutoffPartition)
+    def _insert_job_rows(self, job, val, rows):
+        cmd = JOB_INSERTS[val]
         rmqLogger(self.channel, 'insert', cmd, len(rows))
-        insert = self.session.prepare(cmd)
-        batch  = cql.BatchStatement(consistency_level=cql.ConsistencyLevel.QUORUM)
-        for (lca, abundance, exp_avg, ident_avg, len_avg, md5s, level) in rows:
-            batch.add(insert, (self.version, job, lca, int(abundance), float(exp_avg), float(ident_avg), float(len_avg), int(md5s), int(level)))
-        # update job_info
-        loaded = self.get_info_count(job, 'lca') + len(rows)
-        cmd = "UPDATE job_info SET lcas = ?, loaded = ?, updated_on = ? WHERE version = ? AND job = ?"
+        self.write_job_rows(bulk_load.BatchWriter(self.session), val, self.job_params(job, val, rows))
+        # count after rows are written, a failed batch is not counted
+        self.add_counter(job, val, len(rows))
+        # mark job as loading, blind write
+        cmd = "UPDATE job_info SET loaded = ?, updated_on = ? WHERE version = ? AND job = ?"
         rmqLogger(self.channel, 'update', cmd)
-        update = self.session.prepare(cmd)
-        batch.add(update, (loaded, False, datetime.datetime.now(), self.version, job))
-        # execute atomic batch
-        self.session.execute(batch)
-        return loaded
+        update = cql.BoundStatement(
+            self.prepared.get(cmd),
+            consistency_level=cql.ConsistencyLevel.QUORUM
+        ).bind([False, datetime.datetime.now(), self.version, job])
+        self.session.execute(update)
+        return self.get_counter(job, val)
     ## delete all job data
     def delete_job(self, job):
         job = int(job)
         batch = cql.BatchStatement(consistency_level=cql.ConsistencyLevel.QUORUM)
-        idel = "DELETE FROM job_info WHERE version = %d AND job = %d"%(self.version, job)
-        rmqLogger(self.channel, 'delete', idel)
-        batch.add(cql.SimpleStatement(idel))
-        mdel = "DELETE FROM job_md5s WHERE version = %d AND job = %d"%(self.version, job)
-        rmqLogger(self.channel, 'delete', mdel)
-        batch.add(cql.SimpleStatement(mdel))
-        ldel = "DELETE FROM job_lcas WHERE version = %d AND job = %d"%(self.version, job)
-        rmqLogger(self.channel, 'delete', ldel)
-        batch.add(cql.SimpleStatement(ldel))
+        for table in ['job_info', 'job_md5s', 'job_lcas']:
+            cmd = "DELETE FROM %s WHERE version = ? AND job = ?"%(table)
+            rmqLogger(self.channel, 'delete', cmd)
+            batch.add(self.prepared.get(cmd), (self.version, job))
         self.session.execute(batch)
+        # counter rows are not deleted, a deleted counter can not be reused
+        for val in ['md5', 'lca']:
+            self.reset_counter(job, val)
+            self.reset_cutoffs(job, val, False)
 
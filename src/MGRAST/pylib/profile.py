@@ -1,35 +1,79 @@
 
 import sys
-import time
 import datetime
 import json
+import multiprocessing
 import shock
+import progress
+import mgrast_biom
+import cass_connection
 import mgrast_cassandra
-from collections import defaultdict
+from collections import OrderedDict
 
-UPDATE_SECS  = 300
-M5NR_VERSION = 1
-CHUNK_SIZE   = 100
+UPDATE_SECS   = 300
+M5NR_VERSION  = 1
+CHUNK_SIZE    = 100
+LOOKUP_WINDOW = 8
+PROCESSES     = 1
+MD5_FIELDS    = ['md5', 'abundance', 'exp_avg', 'ident_avg', 'len_avg']
+
+# Profile of a worker process, parts of one job scan are built in a pool
+WORKER = None
+
+def init_worker(hosts, version, chunk, window, ontology):
+    global WORKER
+    cass_connection.forget()
+    WORKER = Profile(hosts, version, chunk, window)
+    WORKER.set_ontology(ontology)
+
+def run_part(task):
+    method, segment, args = task
+    recs = WORKER.jobs.scan_segment(segment)
+    return getattr(WORKER, method)(recs, *args)
 
 class Profile(object):
-    def __init__(self, hosts, version=M5NR_VERSION, chunk=CHUNK_SIZE):
+    def __init__(self, hosts, version=M5NR_VERSION, chunk=CHUNK_SIZE, window=LOOKUP_WINDOW, processes=PROCESSES):
         self.m5nr = mgrast_cassandra.M5nrHandle(hosts, version)
         self.jobs = mgrast_cassandra.JobHandle(hosts, version)
+        self.hosts = hosts
         self.chunk = int(chunk)
         self.shock = None
+        self.reporter = None
         self.version = int(version)
         self.set_ontology()
+        self.set_window(window)
+        self.set_processes(processes)
     
     def set_ontology(self, sources=['Subsystems', 'NOG', 'COG', 'KO']):
         self.ontology = sources
     
+    # number of annotation lookups kept in flight while scanning job rows
+    def set_window(self, window=LOOKUP_WINDOW):
+        self.window = int(window)
+    
+    # number of worker processes a job scan is split across, 1 builds in this process
+    def set_processes(self, processes=PROCESSES):
+        self.processes = max(1, int(processes))
+    
     def set_shock(self, token=None, bearer='mgrast', url='http://shock.mg-rast.org'):
         self.shock = shock.ShockClient(shock_url=url, bearer=bearer, token=token)
     
     def close(self):
+        if self.reporter:
+            self.reporter.stop()
+        self.log_shock()
         self.m5nr.close()
         self.jobs.close()
     
+    # shock request counters of the build, logged once when it closes
+    def log_shock(self):
+        if self.shock is None:
+            return
+        stats = self.shock.get_stats()
+        if stats['requests'] > 0:
+            mgrast_cassandra.rmqLogger(self.jobs.channel, 'shock', self.shock.shock_url, stats=stats)
+        self.shock.reset_stats()
+    
     def compute_profile(self, node, param, attr=None):
         swap    = True if ('swap' in param) and param['swap'] else False
         index   = True if param['condensed'] == 'true' else False
@@ -59,8 +103,12 @@ class Profile(object):
             try:
                 profile    = self.init_biom_profile(param['id'], param['source'], param['source_type'])
                 rows, data = self.get_biom_data(param['job_id'], param['source'], node, swap)
+                mtype = mgrast_biom.matrix_type(mgrast_biom.count_nonzero(data), len(rows), len(profile['columns']), param.get('matrix_type'))
+                if mtype == 'sparse':
+                    data = mgrast_biom.dense_to_sparse(data)
                 profile['rows'] = rows
                 profile['data'] = data
+                profile['matrix_type'] = mtype
                 profile['shape'][0] = len(profile['rows'])
             except Exception as ex:
                 self.error_exit("unable to build BIOM profile", node, ex)
@@ -92,7 +140,7 @@ class Profile(object):
                 return
         
         ## store file in node
-        self.shock.upload(node=node['id'], data=json.dumps(profile), file_name=fname)
+        self.shock.upload_json(node=node['id'], obj=profile, file_name=fname)
         return
     
     def error_exit(self, error, node=None, ex=None):
@@ -155,13 +203,30 @@ class Profile(object):
         }
     
     def get_mgrast_data(self, job, source, index=False, node=None, swap=False):
+        pool = self.start_pool() if self.processes > 1 else None
+        reporter = self.start_progress(node)
+        if pool:
+            total, found, data = 0, 0, []
+            for ptotal, pfound, pdata in self.run_parts(pool, 'mgrast_part', job, (source, index, swap)):
+                total += ptotal
+                found += pfound
+                data.extend(pdata)
+                reporter.report(self.progress_values(total, found))
+        else:
+            recs = self.jobs.resumable_records(job, MD5_FIELDS)
+            total, found, data = self.mgrast_part(recs, source, index, swap, reporter)
+        reporter.close(self.progress_values(total, found, None, 1)) # last update
+        return data
+    
+    # mgrast profile rows of md5 records, in record order
+    def mgrast_part(self, recs, source, index=False, swap=False, reporter=None):
         data = []
         found = 0
-        md5_row = defaultdict(list)
+        md5_row = OrderedDict()
+        lookups = mgrast_cassandra.LookupPipeline(self.m5nr, source=source, index=index, window=self.window)
         
-        def append_profile(found, data, md5_row):
+        def append_profile(found, data, md5_row, ann_data):
             md5_idx = {}
-            ann_data = self.m5nr.get_records_by_md5(md5_row.keys(), source=source, index=index, iterator=True)
             for info in ann_data:
                 if info['md5'] not in md5_idx:
                     found += 1
@@ -172,7 +237,7 @@ class Profile(object):
                 # add annotations to data matrix
                 # md5sum, abundance, e-value, percent identity, alignment length, organisms (first is single), functions (either function or ontology)
                 if info['single'] and info['organism']:
-                    orgs = info['organism']
+                    orgs = list(info['organism'])
                     try:
                         orgs.remove(info['single'])
                     except ValueError:
@@ -187,8 +252,6 @@ class Profile(object):
         
         total = 0
         count = 0
-        prev  = time.time()
-        recs  = self.jobs.get_job_records(job, ['md5', 'abundance', 'exp_avg', 'ident_avg', 'len_avg'])
         for r in recs:
             if swap:
                 md5_row[r[0]] = [r[0], r[1], r[2], r[4], r[3], None, None]
@@ -197,22 +260,27 @@ class Profile(object):
             total += 1
             count += 1
             if count == self.chunk:
-                found, data = append_profile(found, data, md5_row)
-                md5_row = defaultdict(list)
+                for chunk_row, ann_data in lookups.submit(list(md5_row.keys()), md5_row):
+                    found, data = append_profile(found, data, chunk_row, ann_data)
+                md5_row = OrderedDict()
                 count = 0
-            if (total % 1000) == 0:
-                prev = self.update_progress(node, total, found, prev)
+            if reporter and ((total % 1000) == 0):
+                reporter.report(self.progress_values(total, found, lookups))
         if count > 0:
-            found, data = append_profile(found, data, md5_row)
-        self.update_progress(node, total, found, 0) # last update
-        return data
+            for chunk_row, ann_data in lookups.submit(list(md5_row.keys()), md5_row):
+                found, data = append_profile(found, data, chunk_row, ann_data)
+        for chunk_row, ann_data in lookups.drain():
+            found, data = append_profile(found, data, chunk_row, ann_data)
+        if reporter:
+            reporter.report(self.progress_values(total, found, lookups))
+        return total, found, data
     
     def get_lca_data(self, job, node=None, swap=False):
         data  = []
         found = 0
         total = 0
-        prev  = time.time()
-        recs  = self.jobs.get_lca_records(job, ['lca', 'abundance', 'exp_avg', 'ident_avg', 'len_avg', 'md5s', 'level'])
+        reporter = self.start_progress(node)
+        recs  = self.jobs.resumable_records(job, ['lca', 'abundance', 'exp_avg', 'ident_avg', 'len_avg', 'md5s', 'level'], 'lca')
         for r in recs:
             total += 1
             if not r[0]:
@@ -223,19 +291,37 @@ class Profile(object):
                 data.append([r[0], r[1], r[2], r[3], r[4], r[5], r[6]])
             found += 1
             if (total % 1000) == 0:
-                prev = self.update_progress(node, total, found, prev)
-        self.update_progress(node, total, found, 0) # last update
+                reporter.report(self.progress_values(total, found))
+        reporter.close(self.progress_values(total, found, None, 1)) # last update
         return data
     
     def get_biom_data(self, job, source, node=None, swap=False):
+        pool = self.start_pool() if self.processes > 1 else None
+        reporter = self.start_progress(node)
+        if pool:
+            total, found, rows, data = 0, 0, [], []
+            for ptotal, pfound, prows, pdata in self.run_parts(pool, 'biom_part', job, (source, swap)):
+                total += ptotal
+                found += pfound
+                rows.extend(prows)
+                data.extend(pdata)
+                reporter.report(self.progress_values(total, found))
+        else:
+            recs = self.jobs.resumable_records(job, MD5_FIELDS)
+            total, found, rows, data = self.biom_part(recs, source, swap, reporter)
+        reporter.close(self.progress_values(total, found, None, 1)) # last update
+        return rows, data
+    
+    # biom profile rows and data of md5 records, in record order
+    def biom_part(self, recs, source, swap=False, reporter=None):
         rows = []
         data = []
         found = 0
-        md5_row = defaultdict(list)
+        md5_row = OrderedDict()
+        lookups = mgrast_cassandra.LookupPipeline(self.m5nr, source=source, index=False, window=self.window)
         
-        def append_profile(found, rows, data, md5_row):
+        def append_profile(found, rows, data, md5_row, ann_data):
             md5_idx = {}
-            ann_data = self.m5nr.get_records_by_md5(md5_row.keys(), source=source, index=False, iterator=True)
             for info in ann_data:
                 if info['md5'] not in md5_idx:
                     found += 1
@@ -257,8 +343,6 @@ class Profile(object):
         
         total = 0
         count = 0
-        prev  = time.time()
-        recs  = self.jobs.get_job_records(job, ['md5', 'abundance', 'exp_avg', 'ident_avg', 'len_avg'])
         for r in recs:
             if swap:
                 md5_row[r[0]] = [r[1], r[2], r[4], r[3]]
@@ -267,28 +351,52 @@ class Profile(object):
             total += 1
             count += 1
             if count == self.chunk:
-                found, rows, data = append_profile(found, rows, data, md5_row)
-                md5_row = defaultdict(list)
+                for chunk_row, ann_data in lookups.submit(list(md5_row.keys()), md5_row):
+                    found, rows, data = append_profile(found, rows, data, chunk_row, ann_data)
+                md5_row = OrderedDict()
                 count = 0
-            if (total % 1000) == 0:
-                prev = self.update_progress(node, total, found, prev)
+            if reporter and ((total % 1000) == 0):
+                reporter.report(self.progress_values(total, found, lookups))
         if count > 0:
-            found, rows, data = append_profile(found, rows, data, md5_row)
-        self.update_progress(node, total, found, 0) # last update
-        return rows, data
+            for chunk_row, ann_data in lookups.submit(list(md5_row.keys()), md5_row):
+                found, rows, data = append_profile(found, rows, data, chunk_row, ann_data)
+        for chunk_row, ann_data in lookups.drain():
+            found, rows, data = append_profile(found, rows, data, chunk_row, ann_data)
+        if reporter:
+            reporter.report(self.progress_values(total, found, lookups))
+        return total, found, rows, data
     
-    # only update if been more than UPDATE_SECS
-    def update_progress(self, node, total, found, prev):
-        now = time.time()
-        if self.shock and node and (now > (prev + UPDATE_SECS)):
-            attr = node['attributes']
-            attr['progress']['queried'] = total
-            attr['progress']['found'] = found
-            if prev == 0:
-                # final update
-                attr['progress']['completed'] = 1
-            self.shock.upload(node=node['id'], attr=json.dumps(attr))
-            return now
-        else:
-            return prev
+    # forked while no progress thread runs, its held locks would be copied held
+    def start_pool(self):
+        if self.reporter:
+            self.reporter.stop()
+        return multiprocessing.Pool(self.processes, initializer=init_worker, initargs=(self.hosts, self.version, self.chunk, self.window, self.ontology))
+    
+    # results of method for each md5 prefix range of the job, in range order.
+    # ranges concatenate to the sequential scan, so merged output is identical
+    def run_parts(self, pool, method, job, args):
+        try:
+            segments = self.jobs.record_segments(job, 'md5', MD5_FIELDS, self.processes)
+            tasks = [(method, seg, args) for seg in segments]
+            for result in pool.imap(run_part, tasks):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    
+    # background updates of node progress, at most every UPDATE_SECS
+    def start_progress(self, node):
+        if self.reporter:
+            self.reporter.stop()
+        self.reporter = progress.ProgressReporter(self.shock, node, UPDATE_SECS)
+        return self.reporter
     
+    def progress_values(self, total, found, lookups=None, completed=None):
+        values = {'queried': total, 'found': found}
+        if lookups:
+            values['in_flight'] = lookups.in_flight()
+            values['queued'] = lookups.queued
+        if completed:
+            values['completed'] = completed
+        return values
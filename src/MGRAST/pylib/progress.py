@@ -0,0 +1,103 @@
+
+import sys
+import time
+import json
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+UPDATE_SECS = 300
+STOP = object()
+
+class ProgressReporter(object):
+    """Pushes builder progress into a shock node's attributes from a background thread.
+    report() only queues counters. The thread coalesces them and uploads at most
+    once per interval. close() stops the thread and always uploads the final state.
+    Counters go to attributes.progress, or attributes.progress[key] if a key is given
+    and present. Without shock client or node every call is a no-op."""
+
+    def __init__(self, shock, node, interval=UPDATE_SECS):
+        self.shock = shock
+        self.node = node
+        self.interval = interval
+        self.state = {} # key : counters
+        self.queue = queue.Queue()
+        self.thread = None
+        if self.shock and self.node:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def report(self, values, key=None):
+        if self.thread:
+            self.queue.put((key, values))
+
+    # final update, blocks until uploaded
+    def close(self, values=None, key=None):
+        if not self.thread:
+            return
+        if values:
+            self.queue.put((key, values))
+        self.stop()
+        self.merge()
+        self.push()
+
+    # end thread without final update
+    def stop(self):
+        if self.thread:
+            self.queue.put(STOP)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        last = time.time()
+        changed = False
+        while True:
+            # nothing to push, sleep until next report
+            wait = max(0, (last + self.interval) - time.time()) if changed else None
+            try:
+                item = self.queue.get(timeout=wait)
+            except queue.Empty:
+                item = None
+            if item is STOP:
+                return
+            if item:
+                self.update(*item)
+                changed = True
+                if not self.merge():
+                    return
+            if changed and (time.time() >= (last + self.interval)):
+                try:
+                    self.push()
+                except Exception as ex:
+                    # progress is informational, keep building
+                    sys.stderr.write("unable to update progress of node %s: %s\n"%(self.node['id'], ex))
+                last = time.time()
+                changed = False
+
+    # apply all queued counters, False if stop was requested
+    def merge(self):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return True
+            if item is STOP:
+                return False
+            self.update(*item)
+
+    def update(self, key, values):
+        if key not in self.state:
+            self.state[key] = {}
+        self.state[key].update(values)
+
+    def push(self):
+        attr = self.node['attributes']
+        for key, values in self.state.items():
+            if key is None:
+                attr['progress'].update(values)
+            elif key in attr['progress']:
+                attr['progress'][key].update(values)
+        self.shock.upload(node=self.node['id'], attr=json.dumps(attr))
@@ -12,14 +12,167 @@ Authors:
 
 import cStringIO
 import os
+import json
+import time
 import requests
+import tempfile
+import threading
+import functools
 import urllib
+from collections import deque
+from requests.adapters import HTTPAdapter
 from requests_toolbelt import MultipartEncoder
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+SPOOL_SIZE = 64 * 1024 * 1024 # in memory until this size, then temp file
+WRITE_SIZE = 1024 * 1024
+POOL_SIZE  = 10
+RETRIES    = 3
+BACKOFF    = 0.5 # seconds, doubled on each retry
+# PUT / POST bodies are often streams that can not be replayed
+RETRY_METHODS = frozenset(['GET', 'HEAD', 'DELETE', 'OPTIONS'])
+RETRY_STATUS  = [500, 502, 503, 504]
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60] # seconds, upper bounds
+RANGE_GAP  = 64 * 1024        # ranges closer than this are read in one request
+RANGE_SPAN = 16 * 1024 * 1024 # max bytes of one grouped request
+READ_SIZE  = 4 * 1024 * 1024  # download buffer
+PART_MIN   = 8 * 1024 * 1024  # smallest part of a parallel download
+PROGRESS_BYTES = 64 * 1024 * 1024 # sidecar is saved after this many bytes
+
+#-----------------------------------------------------------------------------
+# Functions
+#-----------------------------------------------------------------------------
+
+def retry_policy(retries=RETRIES, backoff=BACKOFF):
+    # keyword names differ between urllib3 versions
+    policy = dict(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUS, raise_on_status=False)
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **policy)
+    except TypeError:
+        return Retry(method_whitelist=RETRY_METHODS, **policy)
+
+# write all of data at offset of file descriptor, os.pwrite if available
+def write_at(fd, data, offset):
+    view = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while len(view) > 0:
+            n = os.pwrite(fd, view, offset)
+            view = view[n:]
+            offset += n
+    else:
+        # descriptor is not shared, seek then write
+        os.lseek(fd, offset, os.SEEK_SET)
+        while len(view) > 0:
+            n = os.write(fd, view)
+            view = view[n:]
+
+# group consecutive (seek, length) ranges into requests of one span,
+# a range joins the previous group if it starts at most gap bytes after it ends
+def group_ranges(ranges, gap=RANGE_GAP, span=RANGE_SPAN):
+    group = []
+    end = None
+    for seek, length in ranges:
+        seek, length = int(seek), int(length)
+        if group and ((seek < end) or ((seek - end) > gap) or ((seek + length - group[0][0]) > span)):
+            yield group
+            group = []
+        group.append((seek, length))
+        end = seek + length
+    if group:
+        yield group
 
 #-----------------------------------------------------------------------------
 # Classes
 #-----------------------------------------------------------------------------
 
+class Fetch(threading.Thread):
+    """Runs func(*args) in a thread, join() returns its result or raises its error."""
+    
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+    
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as ex:
+            self.error = ex
+    
+    def join(self):
+        threading.Thread.join(self)
+        if self.error:
+            raise self.error
+        return self.result
+
+class SpoolReader:
+    """Read-only view of a spooled file for MultipartEncoder: gives its length
+    without fileno() or getvalue(), which would copy the data or roll it to disk."""
+    
+    def __init__(self, spool, length):
+        self.spool = spool
+        self.len = length
+        
+    def read(self, size=-1):
+        data = self.spool.read(size)
+        self.len -= len(data)
+        return data
+    
+    def close(self):
+        self.spool.close()
+
+class DownloadProgress:
+    """Sidecar JSON of a parallel download: node, size and [ start, end, done ] per part.
+    Replaced atomically, a rerun with the same node and size resumes each part at done."""
+    
+    def __init__(self, path, node, size, parts, resume=True):
+        self.path = path
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        self.resumed = False
+        state = None
+        if resume and os.path.isfile(path):
+            try:
+                with open(path) as fh:
+                    state = json.load(fh)
+            except ValueError:
+                state = None
+        if state and (state.get('node') == node) and (state.get('size') == size):
+            self.parts = state['parts']
+            self.resumed = True
+        else:
+            bounds = [(size * i) // parts for i in range(parts + 1)]
+            self.parts = [[bounds[i], bounds[i+1], bounds[i]] for i in range(parts)]
+        self.state = {'node': node, 'size': size, 'parts': self.parts}
+    
+    def update(self, i, done, count):
+        with self.lock:
+            self.parts[i][2] = done
+            self.unsaved += count
+            if self.unsaved >= PROGRESS_BYTES:
+                self._save()
+    
+    def save(self):
+        with self.lock:
+            self._save()
+    
+    def _save(self):
+        tmp = self.path+'.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.state, fh)
+        os.rename(tmp, self.path)
+        self.unsaved = 0
+    
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
 class ShockClient:
     
     shock_url = ''
@@ -27,19 +180,73 @@ class ShockClient:
     token = ''
     bearer = ''
     template = "An exception of type {0} occured. Arguments:\n{1!r}"
-    methods = { 'get': requests.get,
-                'put': requests.put,
-                'post': requests.post,
-                'delete': requests.delete }
+    methods = {}
     
-    def __init__(self, shock_url='http://shock.mg-rast.org', bearer='OAuth', token=None):
+    def __init__(self, shock_url='http://shock.mg-rast.org', bearer='OAuth', token=None, pool_size=POOL_SIZE, retries=RETRIES, backoff=BACKOFF):
         self.shock_url = shock_url
         if token:
             self.set_auth(bearer, token)
+        # one keep-alive session per client, retries with exponential backoff for idempotent verbs
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry_policy(retries, backoff))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.methods = {}
+        for m in ['get', 'put', 'post', 'delete']:
+            self.methods[m] = functools.partial(self._request, m)
+        self.lock = threading.Lock()
+        self.reset_stats()
         
     def set_auth(self, bearer, token):
         self.auth_header = {'Authorization': bearer+' '+token}
     
+    def close(self):
+        self.session.close()
+    
+    def _request(self, method, url, **kwargs):
+        start = time.time()
+        error = False
+        try:
+            return self.session.request(method, url, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self._record(time.time() - start, error)
+    
+    def _record(self, secs, error):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['seconds'] += secs
+            if error:
+                self.stats['errors'] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if secs <= bound:
+                    self.stats['latency'][i] += 1
+                    break
+            else:
+                self.stats['latency'][-1] += 1
+    
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {
+                'requests': 0,
+                'errors'  : 0,
+                'seconds' : 0.0,
+                'latency' : [0 for _ in range(len(LATENCY_BUCKETS)+1)]
+            }
+    
+    # request count, total seconds and latency histogram (count per upper bound, last is overflow)
+    def get_stats(self):
+        with self.lock:
+            buckets = [str(b) for b in LATENCY_BUCKETS] + ['inf']
+            return {
+                'requests': self.stats['requests'],
+                'errors'  : self.stats['errors'],
+                'seconds' : round(self.stats['seconds'], 3),
+                'latency' : dict(zip(buckets, self.stats['latency']))
+            }
+    
     def get_acl(self, node):
         return self._manage_acl(node, 'get')
     
@@ -118,18 +325,94 @@ class ShockClient:
         else:
             return result.text
     
-    def download_to_path(self, node, path, index=None, part=None, chunk=None):
+    # yields data of each (seek, length) range in order. nearby ranges are grouped into
+    # one request, up to workers requests are in flight over the pooled session
+    def download_ranges(self, node, ranges, gap=RANGE_GAP, span=RANGE_SPAN, workers=POOL_SIZE):
+        pending = deque()
+        for group in group_ranges(ranges, gap, span):
+            fetch = Fetch(self._get_range, node, group[0][0], group[-1][0] + group[-1][1] - group[0][0])
+            fetch.start()
+            pending.append((group, fetch))
+            if len(pending) >= workers:
+                for data in self._split_range(*pending.popleft()):
+                    yield data
+        while len(pending) > 0:
+            for data in self._split_range(*pending.popleft()):
+                yield data
+    
+    def _get_range(self, node, seek, length):
+        data = self._get_node_download(node, seek=seek, length=length).content
+        if len(data) != length:
+            raise Exception(u'Shock download of node %s returned %d of %d bytes at %d'%(node, len(data), length, seek))
+        return data
+    
+    def _split_range(self, group, fetch):
+        data = fetch.join()
+        start = group[0][0]
+        for seek, length in group:
+            yield data[seek-start:seek-start+length]
+    
+    # parts > 1 downloads the whole file as that many concurrent byte ranges,
+    # written in place and resumable through the path.progress sidecar
+    def download_to_path(self, node, path, index=None, part=None, chunk=None, parts=1):
         if path == '':
             raise Exception(u'download_to_path requires non-empty path parameter')
+        if (parts > 1) and not (index and part):
+            return self._download_parts(node, path, parts)
         result = self._get_node_download(node, index=index, part=part, chunk=chunk, stream=True)
         with open(path, 'wb') as f:
-            for chunk in result.iter_content(chunk_size=8192): 
-                if chunk:
-                    f.write(chunk)
-                    f.flush()
+            for data in result.iter_content(chunk_size=READ_SIZE):
+                if data:
+                    f.write(data)
+        return path
+    
+    def _download_parts(self, node, path, parts):
+        size = int(self.get_node(node)['file']['size'])
+        parts = max(1, min(parts, size // PART_MIN))
+        resume = os.path.isfile(path) and (os.path.getsize(path) == size)
+        progress = DownloadProgress(path+'.progress', node, size, parts, resume)
+        if not progress.resumed:
+            # preallocate, parts are written at their offsets
+            with open(path, 'wb') as f:
+                f.truncate(size)
+            progress.save()
+        fetches = []
+        for i, (start, end, done) in enumerate(progress.parts):
+            if done < end:
+                fetches.append(Fetch(self._download_part, node, path, progress, i))
+                fetches[-1].start()
+        error = None
+        for fetch in fetches:
+            try:
+                fetch.join()
+            except Exception as ex:
+                error = error or ex
+        progress.save()
+        if error:
+            raise error
+        progress.remove()
         return path
     
-    def _get_node_download(self, node, index=None, part=None, chunk=None, stream=False):
+    def _download_part(self, node, path, progress, i):
+        start, end, done = progress.parts[i]
+        result = self._get_node_download(node, stream=True, seek=done, length=end-done)
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            for data in result.iter_content(chunk_size=READ_SIZE):
+                if not data:
+                    continue
+                data = data[:end-done]
+                write_at(fd, data, done)
+                done += len(data)
+                progress.update(i, done, len(data))
+                if done >= end:
+                    break
+        finally:
+            os.close(fd)
+        if done < end:
+            raise Exception(u'Shock download of node %s ended at %d of part %d-%d'%(node, done, start, end))
+    
+    def _get_node_download(self, node, index=None, part=None, chunk=None, stream=False, seek=None, length=None):
         if node == '':
             raise Exception(u'download requires non-empty node parameter')
         url = '%s/node/%s?download'%(self.shock_url, node)
@@ -137,6 +420,8 @@ class ShockClient:
             url += '&index='+index+'&part='+str(part)
             if chunk:
                 url += '&chunk_size='+str(chunk)
+        elif (seek is not None) and length:
+            url += '&seek=%d&length=%d'%(seek, length)
         try:
             rget = self.methods['get'](url, headers=self.auth_header, stream=stream)
         except Exception as ex:
@@ -255,6 +540,35 @@ class ShockClient:
             raise Exception(u'Shock error %s: %s%s'%(rj['status'], rj['error'][0], ' ('+node+')' if node else ''))
         return rj['data']
     
+    # serialize obj incrementally into a spooled temp file and stream it as upload,
+    # avoids holding the json string and a copy of it next to obj
+    def upload_json(self, node='', obj=None, file_name='', attr=''):
+        spool = self._json_spool(obj)
+        try:
+            return self.upload(node=node, data=spool, attr=attr, file_name=file_name)
+        finally:
+            spool.close()
+    
+    def _json_spool(self, obj):
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        length = 0
+        buf  = []
+        size = 0
+        for chunk in json.JSONEncoder().iterencode(obj):
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= WRITE_SIZE:
+                spool.write(b''.join(buf))
+                length += size
+                buf  = []
+                size = 0
+        spool.write(b''.join(buf))
+        length += size
+        spool.seek(0)
+        return SpoolReader(spool, length)
+    
     # handles 3 cases
     # 1. file path
     # 2. file object (handle)